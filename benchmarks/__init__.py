@@ -0,0 +1,5 @@
+"""
+Benchmarks for the Order REST API service
+
+See benchmarks/run.py
+"""
@@ -0,0 +1,75 @@
+"""
+Latency Proxy
+
+A TCP proxy that delays everything it forwards, so a database on the same
+machine answers like one across the network. Used by benchmarks/concurrency.py,
+where the worker classes only differ when requests wait on the database.
+"""
+import socket
+import threading
+import time
+
+
+class LatencyProxy:
+    """Forwards connections on 127.0.0.1 to a target, adding delay each way
+
+    :param target: (host, port) of a TCP server, or the path of a unix socket
+    :param delay: seconds added to every message in each direction
+    """
+
+    def __init__(self, target, delay):
+        self.target = target
+        self.delay = delay
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+        self._running = True
+
+    def start(self):
+        """Accepts connections in a background thread"""
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stops accepting connections"""
+        self._running = False
+        self.listener.close()
+
+    def _connect(self):
+        if isinstance(self.target, str):
+            upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        upstream.connect(self.target)
+        return upstream
+
+    def _accept(self):
+        while self._running:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            upstream = self._connect()
+            threading.Thread(target=self._pump, args=(client, upstream), daemon=True).start()
+            threading.Thread(target=self._pump, args=(upstream, client), daemon=True).start()
+
+    def _pump(self, source, destination):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                time.sleep(self.delay)
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, destination):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
@@ -0,0 +1,65 @@
+"""
+Gunicorn configuration
+
+Read by gunicorn from the working directory when the service starts
+(see Procfile and Dockerfile). Every setting can be tuned per deployment
+through the environment.
+
+Each worker process opens its own connection pool, so a replica holds up to
+GUNICORN_WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW) database connections.
+
+GUNICORN_WORKER_CLASS=gevent serves up to GUNICORN_WORKER_CONNECTIONS requests
+at once per worker, each in its own greenlet, switching to another request
+whenever one waits on PostgreSQL. Requests beyond the size of the connection
+pool wait for a free connection (DB_POOL_TIMEOUT).
+"""
+import os
+import shutil
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+
+if worker_class == "gevent":
+    # patch before anything creates locks or sockets, the app may be preloaded
+    from gevent import monkey  # pylint: disable=import-outside-toplevel
+    monkey.patch_all()
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:" + os.getenv("PORT", "8080"))
+workers = int(os.getenv("GUNICORN_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+
+# With several workers /metrics must add up the metrics every worker writes
+# to this directory. It has to be set before prometheus_client is imported.
+if workers > 1:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_metrics")
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Drops the metrics files left behind by the previous run"""
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Gives every worker fresh database connections"""
+    if worker_class == "gevent":
+        # psycopg2 waits for the server in C, make it yield to other greenlets
+        from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+        patch_psycopg()
+    if server.cfg.preload_app:
+        # connections opened by the master while preloading must never be
+        # shared between processes
+        from service.models import db  # pylint: disable=import-outside-toplevel
+        db.engine.dispose()
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Stops reporting the live gauges of a worker that exited"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+        multiprocess.mark_process_dead(worker.pid)
@@ -9,6 +9,12 @@ from flask import Flask
 from .models import Order, Item, db
 from service import config
 from .common import log_handlers
+from .common.pool_stats import init_pool_stats
+from .common.cache import init_cache
+from .common.metrics import init_metrics
+from .common.rate_limit import init_rate_limit
+from .common.compression import init_compression
+from .common.serialization import init_serialization
 from flask_admin import Admin
 from flask_admin.contrib.sqla import ModelView
 from flask_restx import Api
@@ -45,9 +51,13 @@ api = Api(
     prefix='/api'
     )
 
+# Encode the JSON responses with the fast encoder
+init_serialization(app, api)
+
 # Dependencies require we import the routes AFTER the Flask app is created
 # pylint: disable=wrong-import-position, wrong-import-order
 from service import routes         # noqa: E402, E261
+from service import commands       # noqa: E402, E261
 # pylint: disable=wrong-import-position
 from .common import error_handlers  # noqa: F401 E402
 
@@ -60,6 +70,21 @@ app.logger.info(70 * "*")
 
 app.logger.info("App Root Path: {}".format(app.root_path))
 
+# Count connection pool usage so the pool settings can be sized
+init_pool_stats()
+
+# Cache single Order lookups
+init_cache(app)
+
+# Export request, database and pool metrics on /metrics
+init_metrics(app)
+
+# Shed load and rate limit the clients of /api, after the metrics so they count the rejections
+init_rate_limit(app)
+
+# Compress large JSON responses, after the metrics so they count the sent bytes
+init_compression(app)
+
 try:
     routes.init_db()  # make our SQLAlchemy tables
 except Exception as error:
@@ -0,0 +1,98 @@
+"""
+Command line maintenance tasks
+
+Run through the flask command, e.g.:
+  flask rebuild-rollups --start 2022-01-01 --batch-days 31
+  flask purge-orders --end 2019-12-31 --archive orders-2019.ndjson
+  flask relay-events --output events.ndjson --follow
+  flask prune-events --days 7
+  flask expire-idempotency-keys --hours 24
+"""
+from datetime import date, datetime, timedelta
+import os
+import sys
+import time
+import click
+from service import app
+from service.models import DailyRollup, IdempotencyKey, Order, OrderEvent
+from service.common.serialization import dumps
+
+
+@app.cli.command("rebuild-rollups")
+@click.option("--start", type=date.fromisoformat, help="The first day to rebuild, YYYY-MM-DD")
+@click.option("--end", type=date.fromisoformat, help="The last day to rebuild, YYYY-MM-DD")
+@click.option("--batch-days", type=click.IntRange(min=1), default=31, show_default=True,
+              help="The number of days rebuilt per transaction")
+def rebuild_rollups(start, end, batch_days):
+    """Recomputes the daily rollups from the orders and items"""
+    days = DailyRollup.rebuild(start, end, batch_days)
+    click.echo(f"Rebuilt the rollups of {days} days")
+
+
+@app.cli.command("purge-orders")
+@click.option("--start", type=date.fromisoformat, help="The first day to purge, YYYY-MM-DD")
+@click.option("--end", type=date.fromisoformat, required=True, help="The last day to purge, YYYY-MM-DD")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000, show_default=True,
+              help="The number of orders deleted per transaction")
+@click.option("--archive", type=click.Path(dir_okay=False),
+              help="Append the orders to this file, one JSON document per line, before deleting them")
+def purge_orders(start, end, batch_size, archive):
+    """Deletes the orders created up to a day, with their items"""
+    if archive is None:
+        deleted = Order.purge(start, end, batch_size)
+    else:
+        with open(archive, "a", encoding="utf-8") as archive_file:
+            def write(orders):
+                # on disk before the batch is deleted
+                archive_file.writelines(dumps(order) + "\n" for order in orders)
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
+            deleted = Order.purge(start, end, batch_size, write)
+    click.echo(f"Purged {deleted} orders")
+
+
+@app.cli.command("relay-events")
+@click.option("--name", default="default", show_default=True,
+              help="The name of the relay, each name keeps its own position")
+@click.option("--output", type=click.Path(dir_okay=False, allow_dash=True), default="-", show_default=True,
+              help="Append the events to this file, one JSON document per line")
+@click.option("--batch-size", type=click.IntRange(min=1), default=500, show_default=True,
+              help="The number of events published per transaction")
+@click.option("--follow", is_flag=True, help="Keep relaying new events until stopped")
+def relay_events(name, output, batch_size, follow):
+    """Publishes the order events after the position of the relay, in order"""
+    with click.open_file(output, "a", encoding="utf-8") as output_file:
+        def write(events):
+            # written out before the position moves past them
+            output_file.writelines(dumps(event) + "\n" for event in events)
+            output_file.flush()
+            if output_file is not sys.stdout:
+                os.fsync(output_file.fileno())
+        while True:
+            relayed = OrderEvent.relay(name, write, batch_size)
+            if relayed:
+                click.echo(f"Relayed {relayed} events", err=True)
+            if not follow:
+                return
+            if not relayed:
+                time.sleep(app.config["EVENT_POLL_INTERVAL"])
+
+
+@app.cli.command("prune-events")
+@click.option("--days", type=click.IntRange(min=0), default=7, show_default=True,
+              help="Keep the events of the last days")
+def prune_events(days):
+    """Deletes the old order events every relay has published"""
+    deleted = OrderEvent.prune(datetime.utcnow() - timedelta(days=days))
+    click.echo(f"Pruned {deleted} events")
+
+
+@app.cli.command("expire-idempotency-keys")
+@click.option("--hours", type=click.IntRange(min=0), default=24, show_default=True,
+              help="Keep the keys of the last hours, retries with them still return the stored response")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000, show_default=True,
+              help="The number of keys deleted per transaction")
+def expire_idempotency_keys(hours, batch_size):
+    """Deletes the old Idempotency-Keys of order creations"""
+    deleted = IdempotencyKey.expire(datetime.utcnow() - timedelta(hours=hours), batch_size)
+    click.echo(f"Expired {deleted} idempotency keys")
@@ -0,0 +1,310 @@
+"""
+Order Cache
+
+Read-through cache of serialized Orders keyed by order id. Orders are read far
+more often than they are written, so the single Order lookups are answered from
+here and the model write methods invalidate the entries they change.
+
+A reader that misses reserves the entry before it reads the database, and its
+value is only stored if the entry was not invalidated in between. Otherwise a
+write committed while the reader was reading could be overwritten with the
+older value until the entry expires.
+
+Backends:
+    memory - an LRU dictionary with a TTL inside each worker process. Other
+             workers only see a change once their copy expires, so CACHE_TTL
+             bounds how stale a read can be.
+    shared - a store shared by all workers and replicas, Redis when CACHE_URL
+             is a redis:// URL, or an in-process stand-in for local://
+    none   - no caching at all (the default)
+"""
+import itertools
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+class LRUCache:
+    """In-process least recently used cache whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # key -> token of the last reservation, dropped when the key changes
+        self._reserved = OrderedDict()
+        self._tokens = itertools.count(1)
+
+    def get(self, key):
+        """Returns the value stored under key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def reserve(self, key):
+        """Returns a token for a set of key, valid until key is deleted"""
+        with self._lock:
+            token = next(self._tokens)
+            self._reserved[key] = token
+            self._reserved.move_to_end(key)
+            while len(self._reserved) > self.maxsize:
+                self._reserved.popitem(last=False)
+        return token
+
+    def set(self, key, value, token=None):
+        """Stores a value under key, evicting the least recently used entries
+
+        With a token from reserve the value is only stored when key was not
+        deleted since.
+        """
+        with self._lock:
+            if token is not None:
+                if self._reserved.get(key) != token:
+                    return
+                del self._reserved[key]
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Removes key from the cache and cancels its reservation"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._reserved.pop(key, None)
+
+    def clear(self):
+        """Removes every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._reserved.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LocalStore:
+    """Stand-in for a Redis server, implementing the few commands SharedCache uses"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, name):
+        """GET name"""
+        with self._lock:
+            entry = self._data.get(name)
+            if entry is None or entry[0] <= self.clock():
+                self._data.pop(name, None)
+                return None
+            return entry[1]
+
+    def set(self, name, value, ex=None):
+        """SET name value EX seconds"""
+        with self._lock:
+            expires = self.clock() + ex if ex else float("inf")
+            self._data[name] = (expires, value)
+
+    def delete(self, *names):
+        """DEL name [name ...]"""
+        with self._lock:
+            for name in names:
+                self._data.pop(name, None)
+
+    def register_script(self, script):  # pylint: disable=unused-argument
+        """Returns a callable running SET_IF_RESERVED_SCRIPT"""
+        return self._set_if_reserved
+
+    def _set_if_reserved(self, keys, args):
+        """Runs SET_IF_RESERVED_SCRIPT"""
+        entry, reservation = keys
+        token, value, ex = args
+        with self._lock:
+            stored = self._data.get(reservation)
+            if stored is None or stored[0] <= self.clock() or stored[1] != token:
+                return 0
+            del self._data[reservation]
+            self._data[entry] = (self.clock() + int(ex), value)
+        return 1
+
+    def scan_iter(self, match=None):
+        """SCAN over the keys starting with the prefix of match"""
+        prefix = (match or "").rstrip("*")
+        with self._lock:
+            keys = [name for name in self._data if name.startswith(prefix)]
+        return iter(keys)
+
+
+# KEYS the entry and its reservation, ARGV the token, the value and the ttl
+SET_IF_RESERVED_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+class SharedCache:
+    """Cache kept in a store shared by every worker, values are stored as JSON"""
+
+    def __init__(self, client, ttl=60, prefix="orders:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.set_if_reserved = client.register_script(SET_IF_RESERVED_SCRIPT)
+
+    def get(self, key):
+        """Returns the value stored under key, or None"""
+        raw = self.client.get(self.prefix + str(key))
+        return None if raw is None else json.loads(raw)
+
+    def reserve(self, key):
+        """Returns a token for a set of key, valid until key is deleted"""
+        token = uuid.uuid4().hex
+        self.client.set(self._reservation(key), token, ex=self.ttl)
+        return token
+
+    def set(self, key, value, token=None):
+        """Stores a value under key for ttl seconds
+
+        With a token from reserve the value is only stored when key was not
+        deleted since, checked and stored atomically by the store.
+        """
+        if token is None:
+            self.client.set(self.prefix + str(key), json.dumps(value), ex=self.ttl)
+        else:
+            self.set_if_reserved(keys=[self.prefix + str(key), self._reservation(key)],
+                                 args=[token, json.dumps(value), self.ttl])
+
+    def delete(self, key):
+        """Removes key from the cache and cancels its reservation"""
+        self.client.delete(self.prefix + str(key), self._reservation(key))
+
+    def _reservation(self, key):
+        """Returns the name of the reservation of key"""
+        return f"{self.prefix}reserved:{key}"
+
+    def clear(self):
+        """Removes every entry of this cache"""
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class NullCache:
+    """Cache that never stores anything"""
+
+    def get(self, key):  # pylint: disable=unused-argument
+        """Always a miss"""
+        return None
+
+    def reserve(self, key):  # pylint: disable=unused-argument
+        """Nothing to reserve"""
+        return None
+
+    def set(self, key, value, token=None):
+        """Drops the value"""
+
+    def delete(self, key):
+        """Nothing to remove"""
+
+    def clear(self):
+        """Nothing to remove"""
+
+
+class OrderCache:
+    """Caches serialized Orders by id and counts hits and misses"""
+
+    def __init__(self, backend=None):
+        self.backend = NullCache() if backend is None else backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, order_id):
+        """Returns the serialized Order, or None on a miss"""
+        data = self.backend.get(int(order_id))
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def reserve(self, order_id):
+        """Reserves the entry of an Order before it is read from the database, see set"""
+        return self.backend.reserve(int(order_id))
+
+    def set(self, order_id, data, token=None):
+        """Caches a serialized Order, which must not be modified afterwards
+
+        With the token of reserve the Order is only cached when it was not
+        invalidated since it was reserved.
+        """
+        self.backend.set(int(order_id), data, token)
+
+    def invalidate(self, order_id):
+        """Drops the Order from the cache after it changed"""
+        if order_id is None:
+            return
+        self.backend.delete(int(order_id))
+        with self._lock:
+            self.invalidations += 1
+
+    def clear(self):
+        """Drops every Order from the cache"""
+        self.backend.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters"""
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+order_cache = OrderCache()
+
+
+def init_cache(app):
+    """Picks the cache backend from the app configuration"""
+    backend_name = app.config["CACHE_BACKEND"]
+    ttl = app.config["CACHE_TTL"]
+    if backend_name == "memory":
+        backend = LRUCache(app.config["CACHE_MAX_SIZE"], ttl)
+    elif backend_name == "shared":
+        url = app.config["CACHE_URL"]
+        if url.startswith("local://"):
+            client = LocalStore()
+        elif redis is None:
+            raise RuntimeError("CACHE_BACKEND=shared needs the redis package for " + url)
+        else:
+            client = redis.Redis.from_url(url)
+        backend = SharedCache(client, ttl)
+    else:
+        backend = NullCache()
+    order_cache.backend = backend
+    app.logger.info("Order cache backend: %s", type(backend).__name__)
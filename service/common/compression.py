@@ -0,0 +1,166 @@
+"""
+Response Compression
+
+Compresses JSON and NDJSON response bodies with the best encoding both the
+client (Accept-Encoding) and the server support:
+
+    zstd  - when the zstandard package is installed
+    br    - when the brotli package is installed
+    gzip  - always available
+
+COMPRESS_ENCODINGS lists the encodings the server offers in order of
+preference, among those the client accepts with the same quality the first
+one wins. Bodies smaller than COMPRESS_MIN_SIZE are sent as they are, the
+saving would not pay for the CPU time. Streamed bodies have no known size and
+are always compressed, chunk by chunk, so the whole body is never held in
+memory.
+
+The bytes saved and the CPU time spent compressing are exported as metrics
+(see service/common/metrics.py).
+"""
+import time
+import zlib
+from flask import current_app, request
+from .metrics import COMPRESSED_RESPONSES, COMPRESSION_SAVED, COMPRESSION_CPU
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson"}
+
+
+class BrotliCompressor:
+    """Gives brotli.Compressor the compress() and flush() of zlib"""
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data):
+        """Compresses a chunk, may keep some of it buffered"""
+        return self.compressor.process(data)
+
+    def flush(self):
+        """Returns the rest of the compressed data"""
+        return self.compressor.finish()
+
+
+# encoding -> function returning a new compressor with compress() and flush()
+COMPRESSORS = {"gzip": lambda: zlib.compressobj(6, zlib.DEFLATED, 31)}
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+
+
+def available_encodings(preference):
+    """Returns the encodings in a comma separated preference that are installed"""
+    return [name.strip() for name in preference.split(",") if name.strip() in COMPRESSORS]
+
+
+def choose_encoding(accept_encodings, offered):
+    """Returns the offered encoding the client prefers, or None
+
+    :param accept_encodings: the Accept-Encoding of the request
+    :type accept_encodings: werkzeug.datastructures.Accept
+
+    :param offered: the encodings of the server in order of preference
+    :type offered: list
+    """
+    best, best_quality = None, 0
+    for name in offered:
+        quality = accept_encodings[name]
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def compress_response(response):
+    """Compresses the body of a JSON response the client can decompress"""
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.status_code in (204, 304) \
+            or "Content-Encoding" in response.headers or request.method == "HEAD":
+        return response
+    response.vary.add("Accept-Encoding")
+    if "no-transform" in response.headers.get("Cache-Control", ""):
+        return response
+    offered = available_encodings(current_app.config["COMPRESS_ENCODINGS"])
+    encoding = choose_encoding(request.accept_encodings, offered)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        started = time.thread_time()
+        compressor = COMPRESSORS[encoding]()
+        compressed = compressor.compress(data) + compressor.flush()
+        cpu = time.thread_time() - started
+        if len(compressed) >= len(data):
+            COMPRESSION_CPU.labels(encoding).inc(cpu)
+            return response
+        _record(encoding, len(data), len(compressed), cpu)
+        response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    # the encoded body is another representation, see check_if_match in routes
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _compress_stream(body, encoding):
+    """Compresses a streamed body as it is generated
+
+    The compressor sends its output as its buffers fill up, so memory stays
+    bounded however long the body is.
+    """
+    compressor = COMPRESSORS[encoding]()
+    size = compressed_size = 0
+    cpu = 0.0
+    try:
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            size += len(chunk)
+            started = time.thread_time()
+            output = compressor.compress(chunk)
+            cpu += time.thread_time() - started
+            if output:
+                compressed_size += len(output)
+                yield output
+        started = time.thread_time()
+        output = compressor.flush()
+        cpu += time.thread_time() - started
+        compressed_size += len(output)
+        yield output
+        _record(encoding, size, compressed_size, cpu)
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+def _record(encoding, size, compressed_size, cpu):
+    """Counts a compressed body"""
+    COMPRESSED_RESPONSES.labels(encoding).inc()
+    COMPRESSION_SAVED.labels(encoding).inc(size - compressed_size)
+    COMPRESSION_CPU.labels(encoding).inc(cpu)
+
+
+def init_compression(app):
+    """Compresses the responses of the app with the configured encodings"""
+    offered = available_encodings(app.config["COMPRESS_ENCODINGS"])
+    app.after_request(compress_response)
+    app.logger.info("Response compression: %s", ", ".join(offered) or "off")
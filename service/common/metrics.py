@@ -0,0 +1,203 @@
+"""
+Prometheus Metrics
+
+Collects per request metrics and serves them in the Prometheus text format on
+/metrics:
+
+    http_requests_total                  requests by resource, method and status
+    http_request_duration_seconds        latency histogram by resource and method
+    http_response_size_bytes             response body size by resource and method
+    db_queries_per_request               SQL statements run by one request
+    db_query_duration_seconds_per_request time one request spent in SQL
+    db_pool_*                            connection pool usage
+    http_compressed_responses_total      responses compressed, by encoding
+    http_compression_saved_bytes_total   bytes compression took off the bodies
+    http_compression_cpu_seconds_total   CPU time spent compressing
+    http_rejected_requests_total         requests shed or rate limited, by reason
+
+The resource label is the flask-restx Resource class that handled the request
+(OrderCollection, OrderResource, ...) or the name of a plain Flask view, so the
+number of series stays bounded whatever ids appear in the URLs. Requests that
+match no route are counted as "unmatched".
+
+Every gunicorn worker keeps its own metrics. When PROMETHEUS_MULTIPROC_DIR is
+set, the workers write them to files in that directory and /metrics adds them
+up across all workers of the replica (see gunicorn.conf.py).
+"""
+import os
+import time
+from flask import current_app, g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+)
+from prometheus_client import multiprocess
+from .pool_stats import pool_stats
+
+LABELS = ("resource", "method")
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests handled", LABELS + ("status",)
+)
+LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to handle a request, including a streamed body", LABELS,
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "Size of the response body", LABELS,
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216),
+)
+DB_QUERIES = Histogram(
+    "db_queries_per_request", "SQL statements run by a request", LABELS,
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100, 250),
+)
+DB_TIME = Histogram(
+    "db_query_duration_seconds_per_request", "Time a request spent running SQL statements", LABELS,
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+POOL_CONNECTS = Counter("db_pool_connects_total", "Database connections opened")
+POOL_CHECKOUTS = Counter("db_pool_checkouts_total", "Connections handed out by the pool")
+POOL_INVALIDATIONS = Counter("db_pool_invalidations_total", "Broken connections discarded")
+POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Connections currently in use", multiprocess_mode="livesum"
+)
+COMPRESSED_RESPONSES = Counter(
+    "http_compressed_responses_total", "Responses sent compressed", ("encoding",)
+)
+COMPRESSION_SAVED = Counter(
+    "http_compression_saved_bytes_total", "Bytes compression took off the response bodies", ("encoding",)
+)
+COMPRESSION_CPU = Counter(
+    "http_compression_cpu_seconds_total", "CPU time spent compressing response bodies", ("encoding",)
+)
+REJECTED_REQUESTS = Counter(
+    "http_rejected_requests_total", "Requests turned away before reaching a route", ("reason",)
+)
+POOL_HOLD_TIME = Counter(
+    "db_pool_hold_seconds_total", "Time connections were held, divide its rate by the pool size for utilization"
+)
+
+
+class RequestMetrics:
+    """What a single request did, kept on flask.g while it runs"""
+
+    __slots__ = ("started", "queries", "query_seconds", "size")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.size = 0
+
+
+def resource_name():
+    """Returns the name of the Resource or view that matched the request"""
+    if request.url_rule is None:
+        return "unmatched"
+    endpoint = request.url_rule.endpoint
+    view_class = getattr(current_app.view_functions.get(endpoint), "view_class", None)
+    return view_class.__name__ if view_class else endpoint
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def before_request():
+    """Starts measuring the request"""
+    g.request_metrics = RequestMetrics()
+
+
+def after_request(response):
+    """Records the request once its body has been sent"""
+    metrics = g.get("request_metrics")
+    if metrics is None:
+        return response
+    labels = (resource_name(), request.method)
+    status_code = str(response.status_code)
+    if response.is_streamed:
+        response.response = _count_bytes(response.response, metrics)
+    else:
+        metrics.size = response.content_length or 0
+
+    def record():
+        REQUESTS.labels(*labels, status_code).inc()
+        LATENCY.labels(*labels).observe(time.perf_counter() - metrics.started)
+        RESPONSE_SIZE.labels(*labels).observe(metrics.size)
+        DB_QUERIES.labels(*labels).observe(metrics.queries)
+        DB_TIME.labels(*labels).observe(metrics.query_seconds)
+
+    response.call_on_close(record)
+    return response
+
+
+def _count_bytes(body, metrics):
+    """Passes a streamed body through while adding up its size"""
+    try:
+        for chunk in body:
+            metrics.size += len(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+######################################################################
+#  D A T A B A S E   E V E N T S
+######################################################################
+def before_cursor_execute(conn, cursor, statement, parameters,  # pylint: disable=unused-argument,too-many-arguments
+                          context, executemany):
+    """Notes when a statement started"""
+    context.metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters,  # pylint: disable=unused-argument,too-many-arguments
+                         context, executemany):
+    """Charges a finished statement to the request that ran it"""
+    if not has_request_context():
+        return
+    # stream_with_context keeps g alive while a streamed body is generated
+    metrics = g.get("request_metrics")
+    if metrics is not None:
+        metrics.queries += 1
+        metrics.query_seconds += time.perf_counter() - context.metrics_started
+
+
+def on_pool_event(name, held):
+    """Counts an event of the connection pool, passed on by pool_stats"""
+    if name == "connect":
+        POOL_CONNECTS.inc()
+    elif name == "checkout":
+        POOL_CHECKOUTS.inc()
+        POOL_CHECKED_OUT.inc()
+    elif name == "checkin":
+        POOL_CHECKED_OUT.dec()
+        POOL_HOLD_TIME.inc(held)
+    elif name == "invalidate":
+        POOL_INVALIDATIONS.inc()
+
+
+######################################################################
+#  E X P O S I T I O N
+######################################################################
+def metrics_view():
+    """Serves the metrics of this replica in the Prometheus text format"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app):
+    """Instruments the app, its database engine and pool, and adds /metrics"""
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    # the pool events are listened to once, by pool_stats (see init_pool_stats)
+    if on_pool_event not in pool_stats.observers:
+        pool_stats.observers.append(on_pool_event)
@@ -0,0 +1,49 @@
+"""
+Pagination helpers
+
+Keyset (cursor) pagination tokens handed out to clients as opaque strings.
+A token is the URL-safe base64 encoding of the sort key of the last
+resource the client has seen, so the next page can be fetched with an
+indexed ``WHERE key > last_key`` instead of an ``OFFSET`` scan.
+"""
+import base64
+import binascii
+import json
+
+
+class InvalidTokenError(ValueError):
+    """ Used when a page token can not be decoded """
+
+
+def encode_token(cursor):
+    """Encodes a cursor dictionary into an opaque page token
+
+    :param cursor: the sort key values of the last resource returned
+    :type cursor: dict
+
+    :return: the URL-safe page token
+    :rtype: str
+    """
+    raw = json.dumps(cursor, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_token(token):
+    """Decodes an opaque page token back into its cursor dictionary
+
+    :param token: a token previously returned by encode_token
+    :type token: str
+
+    :return: the cursor dictionary
+    :rtype: dict
+
+    :raises InvalidTokenError: if the token is malformed
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        cursor = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (binascii.Error, ValueError) as error:
+        raise InvalidTokenError(f"Invalid page token: {token}") from error
+    if not isinstance(cursor, dict):
+        raise InvalidTokenError(f"Invalid page token: {token}")
+    return cursor
@@ -0,0 +1,107 @@
+"""
+Connection Pool Statistics
+
+Counts what the SQLAlchemy connection pool of this worker process does, so the
+pool settings in service/config.py can be sized from real traffic: the sum of
+the connection hold times over the wall clock time is the average number of
+connections a worker really needs. Other modules follow the same events
+through observers (the Prometheus metrics), so the pool has one set of
+listeners.
+"""
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.pool import Pool, QueuePool
+
+
+class PoolStats:
+    """Thread safe counters fed by the pool events
+
+    Every observer is called with the name of each event counted, connect,
+    checkout, checkin or invalidate, and for a checkin the seconds the
+    connection was held.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.observers = []
+        self.started = time.time()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.hold_seconds = 0.0
+
+    def on_connect(self, dbapi_connection, connection_record):  # pylint: disable=unused-argument
+        """A new DBAPI connection was opened"""
+        with self._lock:
+            self.connects += 1
+        self._notify("connect")
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):  # pylint: disable=unused-argument
+        """A connection was handed out by the pool"""
+        connection_record.info["checkout_at"] = time.perf_counter()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+        self._notify("checkout")
+
+    def on_checkin(self, dbapi_connection, connection_record):  # pylint: disable=unused-argument
+        """A connection went back to the pool"""
+        checkout_at = connection_record.info.pop("checkout_at", None)
+        if checkout_at is None:
+            return
+        held = time.perf_counter() - checkout_at
+        with self._lock:
+            self.checkins += 1
+            self.checked_out -= 1
+            self.hold_seconds += held
+        self._notify("checkin", held)
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):  # pylint: disable=unused-argument
+        """A connection was found broken and discarded"""
+        with self._lock:
+            self.invalidations += 1
+        self._notify("invalidate")
+
+    def _notify(self, name, held=0.0):
+        """Passes an event on to the observers"""
+        for observer in self.observers:
+            observer(name, held)
+
+    def snapshot(self, pool=None):
+        """Returns the counters, and the state of the pool if one is given"""
+        with self._lock:
+            stats = {
+                "pid": os.getpid(),
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "hold_seconds": round(self.hold_seconds, 6),
+            }
+        if isinstance(pool, QueuePool):
+            stats["pool_size"] = pool.size()
+            stats["idle"] = pool.checkedin()
+            stats["overflow"] = pool.overflow()
+        return stats
+
+
+pool_stats = PoolStats()
+
+
+def init_pool_stats():
+    """Starts counting the events of every connection pool of the process"""
+    if event.contains(Pool, "checkout", pool_stats.on_checkout):
+        return
+    event.listen(Pool, "connect", pool_stats.on_connect)
+    event.listen(Pool, "checkout", pool_stats.on_checkout)
+    event.listen(Pool, "checkin", pool_stats.on_checkin)
+    event.listen(Pool, "invalidate", pool_stats.on_invalidate)
@@ -0,0 +1,320 @@
+"""
+Rate Limiting and Load Shedding
+
+Every request to /api is checked before it reaches a route, so a request that
+is turned away never touches the database:
+
+1. Load shedding answers 503 Service Unavailable when the worker already has
+   more work queued than the database can take:
+     SHED_MAX_IN_FLIGHT  requests the worker handles at once. Under the gevent
+                         worker (or threads) the requests beyond the connection
+                         pool only wait for a connection, a few of them keep
+                         the pool busy, more only add latency for everyone.
+     SHED_MAX_QUEUE_MS   how long the request waited before the worker took
+                         it, from the X-Request-Start header set by the router.
+                         A sync worker handles one request at a time, its
+                         queue is the listen backlog and only shows up here.
+
+2. Rate limiting answers 429 Too Many Requests when a client sends more than
+   RATE_LIMIT_RATE requests per second, after a burst of RATE_LIMIT_BURST. Each
+   client has a token bucket, the client is the X-Api-Key header when it is
+   one of RATE_LIMIT_API_KEYS and the remote address otherwise. A key anyone
+   can make up would give a client rotating keys a fresh bucket per request.
+
+Both answers carry Retry-After. The buckets are kept by one of the backends:
+
+    memory - a dictionary inside each worker process: with several workers
+             or replicas a client gets the rate of every one of them
+    shared - a store shared by all workers and replicas, Redis when
+             RATE_LIMIT_URL is a redis:// URL, where one Lua script refills and
+             takes from a bucket atomically, or an in-process stand-in for
+             local://
+    none   - no rate limiting
+
+When the shared store can not be reached requests are let through: losing the
+limit is better than losing the service.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, jsonify, request
+from . import status
+from .metrics import REJECTED_REQUESTS
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+RATE_LIMITED_PREFIX = "/api/"
+
+
+def take_token(tokens, updated, now, rate, burst):
+    """Refills a bucket up to now and takes one token out of it
+
+    :return: the tokens left, whether one was taken and the seconds until
+             the next one
+    :rtype: tuple
+    """
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, True, 0.0
+    return tokens, False, (1 - tokens) / rate
+
+
+class TokenBuckets:
+    """Token buckets of the clients kept in this process, the least recently seen are dropped"""
+
+    def __init__(self, rate, burst, max_clients=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, client):
+        """Takes a token from the bucket of a client
+
+        :return: whether the request is allowed and the seconds until it would be
+        :rtype: tuple
+        """
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens, allowed, retry_after = take_token(tokens, updated, now, self.rate, self.burst)
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# KEYS[1] the bucket, ARGV the time in seconds, the rate and the burst. The
+# same arithmetic as take_token, numbers are returned as strings so Redis does
+# not truncate them to integers.
+TOKEN_BUCKET_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local now, rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed, retry_after = 0, (1 - tokens) / rate
+if tokens >= 1 then
+    tokens, allowed, retry_after = tokens - 1, 1, 0
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+
+class LocalBucketStore:
+    """Stand-in for a Redis server running TOKEN_BUCKET_SCRIPT, with take_token in Python"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def register_script(self, script):  # pylint: disable=unused-argument
+        """Returns a callable running the token bucket script"""
+        return self._run
+
+    def _run(self, keys, args):
+        """Runs the script on one bucket"""
+        now, rate, burst = (float(arg) for arg in args)
+        with self._lock:
+            tokens, updated = self._data.get(keys[0], (burst, now))
+            tokens, allowed, retry_after = take_token(tokens, updated, now, rate, burst)
+            self._data[keys[0]] = (tokens, now)
+        return [int(allowed), str(retry_after)]
+
+
+class SharedTokenBuckets:
+    """Token buckets kept in a store shared by every worker"""
+
+    def __init__(self, client, rate, burst, prefix="ratelimit:", clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self.clock = clock
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, client):
+        """Takes a token from the bucket of a client
+
+        :return: whether the request is allowed and the seconds until it would be
+        :rtype: tuple
+        """
+        allowed, retry_after = self.script(keys=[self.prefix + client], args=[self.clock(), self.rate, self.burst])
+        return bool(int(allowed)), float(retry_after)
+
+
+def parse_request_start(value):
+    """Returns the time in seconds since the epoch of an X-Request-Start header, None if invalid
+
+    Routers send seconds (nginx: t=1600000000.123), milliseconds (Heroku) or
+    microseconds (t=1600000000123456).
+    """
+    try:
+        started = float(value.strip().replace("t=", ""))
+    except (AttributeError, ValueError):
+        return None
+    if started > 1e14:
+        return started / 1e6
+    if started > 1e11:
+        return started / 1e3
+    return started
+
+
+class LoadShedder:
+    """Counts the requests a worker is handling and tells when there are too many"""
+
+    def __init__(self, max_in_flight=0, max_queue_seconds=0.0, clock=time.time):
+        self.max_in_flight = max_in_flight
+        self.max_queue_seconds = max_queue_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def enter(self):
+        """Counts a request in, returns the number in flight with it"""
+        with self._lock:
+            self.in_flight += 1
+            return self.in_flight
+
+    def leave(self):
+        """Counts a request out"""
+        with self._lock:
+            self.in_flight -= 1
+
+    def overload(self, in_flight, request_start=None):
+        """Returns why a request should be turned away, None when it can be handled
+
+        :param in_flight: the requests in flight with this one, see enter
+        :type in_flight: int
+
+        :param request_start: the X-Request-Start header of the request
+        :type request_start: str
+        """
+        if self.max_in_flight and in_flight > self.max_in_flight:
+            return "in_flight"
+        if self.max_queue_seconds and request_start:
+            started = parse_request_start(request_start)
+            if started is not None and self.clock() - started > self.max_queue_seconds:
+                return "queue_time"
+        return None
+
+
+class RateLimiter:
+    """The token buckets of the clients and the load shedder of this worker"""
+
+    def __init__(self):
+        self.buckets = None
+        self.api_keys = set()
+        self.shedder = LoadShedder()
+        self.shed_retry_after = 1
+
+    def configure(self, config):
+        """Builds the backend and the limits from the app configuration"""
+        backend_name = config["RATE_LIMIT_BACKEND"]
+        rate, burst = config["RATE_LIMIT_RATE"], config["RATE_LIMIT_BURST"]
+        if backend_name == "memory":
+            self.buckets = TokenBuckets(rate, burst, config["RATE_LIMIT_MAX_CLIENTS"])
+        elif backend_name == "shared":
+            url = config["RATE_LIMIT_URL"]
+            if url.startswith("local://"):
+                client = LocalBucketStore()
+            elif redis is None:
+                raise RuntimeError("RATE_LIMIT_BACKEND=shared needs the redis package for " + url)
+            else:
+                client = redis.Redis.from_url(url, socket_timeout=0.1)
+            self.buckets = SharedTokenBuckets(client, rate, burst)
+        else:
+            self.buckets = None
+        self.api_keys = {key_digest(key.strip()) for key in config["RATE_LIMIT_API_KEYS"].split(",") if key.strip()}
+        self.shedder.max_in_flight = config["SHED_MAX_IN_FLIGHT"]
+        self.shedder.max_queue_seconds = config["SHED_MAX_QUEUE_MS"] / 1000
+        self.shed_retry_after = config["SHED_RETRY_AFTER"]
+
+    def take(self, client):
+        """Takes a token of a client, lets the request through when the store fails"""
+        try:
+            return self.buckets.take(client)
+        except Exception as error:  # pylint: disable=broad-except
+            current_app.logger.warning("Rate limit store failed, request let through: %s", error)
+            return True, 0.0
+
+
+def key_digest(api_key):
+    """Returns the digest an X-Api-Key is kept and looked up by"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:32]
+
+
+rate_limiter = RateLimiter()
+
+
+def client_key():
+    """Returns who the request counts against, a digest of its X-Api-Key when known or its address
+
+    Unknown keys count against the address, so random keys neither get a
+    bucket each nor push the buckets of the other clients out of memory.
+    """
+    api_key = request.headers.get("X-Api-Key")
+    if api_key:
+        digest = key_digest(api_key)
+        if digest in rate_limiter.api_keys:
+            return "key:" + digest
+    return "addr:" + (request.remote_addr or "unknown")
+
+
+def _reject(status_code, error, message, retry_after, reason):
+    """Builds the response turning a request away"""
+    REJECTED_REQUESTS.labels(reason).inc()
+    current_app.logger.warning("%s %s rejected: %s", request.method, request.path, message)
+    response = jsonify(status=status_code, error=error, message=message)
+    response.status_code = status_code
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def before_request():
+    """Turns the request away when the worker is overloaded or the client over its rate"""
+    if not request.path.startswith(RATE_LIMITED_PREFIX):
+        return None
+    g.rate_limit_in_flight = True
+    shedder = rate_limiter.shedder
+    reason = shedder.overload(shedder.enter(), request.headers.get("X-Request-Start"))
+    if reason is not None:
+        return _reject(status.HTTP_503_SERVICE_UNAVAILABLE, "Service Unavailable",
+                       "The service is overloaded, retry later", rate_limiter.shed_retry_after, reason)
+    if rate_limiter.buckets is None:
+        return None
+    allowed, retry_after = rate_limiter.take(client_key())
+    if not allowed:
+        return _reject(status.HTTP_429_TOO_MANY_REQUESTS, "Too Many Requests",
+                       "The rate limit of the client was exceeded", retry_after, "rate_limited")
+    return None
+
+
+def teardown_request(exception):  # pylint: disable=unused-argument
+    """Counts the request out of the worker"""
+    if g.pop("rate_limit_in_flight", False):
+        rate_limiter.shedder.leave()
+
+
+def init_rate_limit(app):
+    """Checks the requests of the app against the configured limits"""
+    rate_limiter.configure(app.config)
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+    app.logger.info("Rate limit backend: %s, shedding above %s requests in flight or %s ms queued",
+                    type(rate_limiter.buckets).__name__, rate_limiter.shedder.max_in_flight or "any",
+                    app.config["SHED_MAX_QUEUE_MS"] or "any")
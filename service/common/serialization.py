@@ -0,0 +1,178 @@
+"""
+Response Serialization
+
+The list endpoints send thousands of Orders per response, so the way they are
+turned into JSON matters:
+
+    dumps          - the JSON encoder picked by JSON_BACKEND: orjson (several
+                     times faster, used when it is installed) or the standard
+                     library json module
+    output_json    - the flask-restx representation of application/json using it
+    compile_model  - turns a flask-restx model into a function giving the same
+                     result as marshal() for a dict, without walking the fields
+                     generically for every value
+"""
+import json
+from datetime import date
+from decimal import Decimal
+from flask import current_app, make_response
+from flask_restx import fields, marshal
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(value):
+    """Encodes the values the JSON encoders do not know"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(data, backend=None):
+    """Encodes data as JSON text with the configured backend
+
+    :param data: the data to encode
+    :param backend: "orjson" or "json", JSON_BACKEND of the app by default
+
+    :return: the JSON document
+    :rtype: str
+    """
+    if backend is None:
+        backend = current_app.config.get("JSON_BACKEND", "orjson")
+    if backend == "orjson" and orjson is not None:
+        return orjson.dumps(data, default=_default).decode("utf-8")
+    return json.dumps(data, default=_default)
+
+
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON encoded body, like flask-restx does"""
+    response = make_response(dumps(data) + "\n", code)
+    response.headers.extend(headers or {})
+    return response
+
+
+def init_serialization(app, api):
+    """Encodes the JSON responses of the api with the JSON_BACKEND"""
+    backend = app.config.get("JSON_BACKEND", "orjson")
+    if backend == "orjson" and orjson is None:
+        app.logger.warning("orjson is not installed, using the json module")
+    api.representations["application/json"] = output_json
+
+
+######################################################################
+#  P R E C O M P I L E D   M O D E L S
+######################################################################
+def compile_model(model):
+    """Returns a function marshalling a dict like marshal(data, model) does
+
+    Each field is turned into a converter once, specialized for the field
+    types the service uses. Other fields, and fields with a mask or an
+    attribute, fall back to the field's own output().
+
+    :param model: the flask-restx model
+    :type model: Model
+
+    :return: a function taking a dict and returning the marshalled dict
+    :rtype: function
+    """
+    if hasattr(model, "resolved"):
+        model = model.resolved  # with the fields inherited from its parents
+    converters = [(name, _compile_field(name, field)) for name, field in model.items()]
+
+    def convert(data):
+        return {name: converter(data) for name, converter in converters}
+
+    return convert
+
+
+def compile_list(model):
+    """Returns a function marshalling a list of dicts like marshal(data, model)"""
+    convert = compile_model(model)
+    return lambda data: [convert(row) for row in data]
+
+
+def _compile_field(name, field):
+    """Returns a function giving the marshalled value of a field of a dict"""
+    if isinstance(field, type):
+        field = field()
+    converter = None
+    if not (getattr(field, "attribute", None) or getattr(field, "mask", None)):
+        compiler = _compile_nested if isinstance(field, fields.Nested) else FIELD_COMPILERS.get(type(field))
+        if compiler is not None:
+            converter = compiler(name, field)
+    if converter is None:
+        return lambda data: field.output(name, data)
+    return converter
+
+
+def _compile_nested(name, field):
+    """Compiles a Nested field"""
+    nested = compile_model(field.nested)
+    allow_null, default = field.allow_null, field.default
+
+    def convert_nested(data):
+        value = data.get(name)
+        if value is None:
+            if allow_null:
+                return None
+            if default is not None:
+                return default
+            return marshal(value, field.nested)
+        return nested(value)
+    return convert_nested
+
+
+def _compile_list(name, field):
+    """Compiles a List of Nested fields, None for other Lists"""
+    if not isinstance(field.container, fields.Nested) or field.container.attribute:
+        return None
+    nested = compile_model(field.container.nested)
+    return _with_default(field, name, lambda value: [nested(row) for row in value])
+
+
+def _compile_date(name, field):
+    """Compiles an ISO 8601 Date field, None for other formats"""
+    if field.dt_format != "iso8601":
+        return None
+
+    def format_date(value):
+        return value.isoformat() if type(value) is date else field.format(value)
+    return _with_default(field, name, format_date)
+
+
+def _compile_format(formatter):
+    """Returns a compiler of the fields whose values only need formatter"""
+    return lambda name, field: _with_default(field, name, formatter, checked=True)
+
+
+# field type -> function compiling a field of exactly that type, or returning None
+FIELD_COMPILERS = {
+    fields.List: _compile_list,
+    fields.Date: _compile_date,
+    fields.Integer: _compile_format(int),
+    fields.Float: _compile_format(float),
+    fields.String: _compile_format(str),
+}
+
+
+def _with_default(field, name, formatter, checked=False):
+    """Wraps a formatter with the handling of missing values of Raw.output"""
+    default = field.default
+    missing = field.format(default) if default else default
+
+    def convert(data):
+        value = data.get(name)
+        if value is None:
+            return missing
+        if checked:
+            try:
+                return formatter(value)
+            except (TypeError, ValueError):
+                return field.output(name, data)  # raises the MarshallingError
+        return formatter(value)
+    return convert
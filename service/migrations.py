@@ -0,0 +1,424 @@
+"""
+Schema Migrations
+
+db.create_all() only creates the tables that are missing, it never changes a
+table that already exists. Every change to the schema of an existing table is
+therefore also written down here as a numbered migration, so a database built
+by an older version of the service is brought up to date in place, without
+dropping its data.
+
+The version a database is at is kept in the schema_version table. A brand new
+database is built by create_all() straight from the models and only stamped
+with the latest version. Migrations must stay idempotent, they may run against
+a database that create_all() has just brought partly up to date.
+
+Every worker of every replica upgrades the database when it starts. On
+PostgreSQL they take turns through an advisory lock, the ones that get it
+after the first find the database already up to date.
+"""
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, distinct, func, inspect, select, text
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+logger = logging.getLogger("flask.app")
+
+# Kept out of db.metadata so db.drop_all() does not forget the schema version
+version_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False, default=datetime.utcnow),
+)
+
+# (version, description, function, transactional) sorted by version
+MIGRATIONS = []
+
+# The PostgreSQL advisory lock held while the schema is upgraded
+MIGRATION_LOCK_KEY = 0x0bde5c4e
+
+
+def migration(version, transactional=True):
+    """Registers a function as the migration to the given schema version
+
+    The function is called with a Connection and the MetaData of the models.
+    Migrations that can not run inside a transaction (such as building an
+    index concurrently on PostgreSQL) are run on an autocommit connection.
+    """
+    def register(func):
+        MIGRATIONS.append((version, func.__doc__.strip(), func, transactional))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return func
+    return register
+
+
+def head():
+    """Returns the latest schema version"""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(engine):
+    """Returns the schema version the database is at"""
+    with engine.connect() as connection:
+        version = connection.execute(
+            text("SELECT MAX(version) FROM schema_version")
+        ).scalar()
+    return version or 0
+
+
+def upgrade(db):
+    """Creates missing tables and applies all pending migrations
+
+    :param db: the SQLAlchemy object bound to the Flask app
+    :type db: SQLAlchemy
+
+    :return: the schema version the database is now at
+    :rtype: int
+
+    """
+    with _migration_lock(db.engine):
+        return _upgrade(db)
+
+
+@contextmanager
+def _migration_lock(engine):
+    """Holds the migration lock, so one process at a time upgrades a PostgreSQL database
+
+    The lock is held by a connection of its own in autocommit mode, which keeps
+    no transaction open that the concurrent index builds would wait for.
+    """
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        logger.info("Waiting for the migration lock")
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+def _upgrade(db):
+    """Upgrades the database, see upgrade"""
+    engine = db.engine
+    existing = inspect(engine).get_table_names()
+    fresh = not any(name in existing for name in db.metadata.tables)
+    db.create_all()
+    version_metadata.create_all(engine)
+
+    version = current_version(engine)
+    if fresh and version == 0:
+        logger.info("New database, stamping schema version %d", head())
+        with engine.begin() as connection:
+            for entry in MIGRATIONS:
+                _record(connection, entry)
+        return head()
+
+    for entry in MIGRATIONS:
+        number, description, func, transactional = entry
+        if number <= version:
+            continue
+        logger.info("Applying migration %d: %s", number, description)
+        if transactional:
+            with engine.begin() as connection:
+                func(connection, db.metadata)
+                _record(connection, entry)
+        else:
+            with engine.connect() as connection:
+                func(connection.execution_options(isolation_level="AUTOCOMMIT"), db.metadata)
+            with engine.begin() as connection:
+                _record(connection, entry)
+        version = number
+    return version
+
+
+def _record(connection, entry):
+    """Writes an applied migration into schema_version"""
+    connection.execute(
+        schema_version.insert().values(version=entry[0], description=entry[1])
+    )
+
+
+######################################################################
+#  O N L I N E   S C H E M A   C H A N G E S
+######################################################################
+def create_index(connection, metadata, table_name, index_name):
+    """Creates an index declared on a model if it does not exist yet
+
+    On PostgreSQL the index is built CONCURRENTLY so writes to the table
+    are not blocked while it builds. That needs an autocommit connection.
+    """
+    index = next(
+        index for index in metadata.tables[table_name].indexes if index.name == index_name
+    )
+    if connection.dialect.name != "postgresql":
+        index.create(connection, checkfirst=True)
+        return
+    # compiled from the model, so indexes on expressions are built the same way
+    ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+    connection.execute(text(ddl.replace("INDEX", "INDEX CONCURRENTLY IF NOT EXISTS", 1)))
+
+
+def add_column(connection, metadata, table_name, column_name):
+    """Adds a column declared on a model if the table does not have it yet
+
+    The column must have a server_default or be nullable. On PostgreSQL 11
+    and later adding a column with a constant default does not rewrite the
+    table, the default is filled in when the rows are read.
+    """
+    existing = {column["name"] for column in inspect(connection).get_columns(table_name)}
+    if column_name in existing:
+        return
+    column = metadata.tables[table_name].c[column_name]
+    preparer = connection.dialect.identifier_preparer
+    definition = CreateColumn(column).compile(dialect=connection.dialect)
+    connection.execute(text(
+        f"ALTER TABLE {preparer.format_table(column.table)} ADD COLUMN {definition}"
+    ))
+
+
+def replace_foreign_keys(connection, metadata, table_name):
+    """Gives the foreign keys of a table the ON DELETE declared on the model
+
+    On PostgreSQL every key is replaced in one ALTER TABLE as NOT VALID, which
+    does not scan the table, then validated by a second statement that lets
+    writes through. That needs an autocommit connection. SQLite can not alter
+    a constraint, the table is rebuilt from the model and its rows copied.
+    """
+    table = metadata.tables[table_name]
+    stored = {
+        tuple(key["constrained_columns"]): key
+        for key in inspect(connection).get_foreign_keys(table_name)
+    }
+    changed = [
+        key for key in table.foreign_key_constraints
+        if tuple(key.column_keys) in stored
+        and (stored[tuple(key.column_keys)]["options"].get("ondelete") or "").upper() != (key.ondelete or "").upper()
+    ]
+    if not changed:
+        return
+    if connection.dialect.name != "postgresql":
+        with connection.engine.begin() as rebuild:
+            _rebuild_sqlite_table(rebuild, table)
+        return
+    preparer = connection.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    for key in changed:
+        constraint = preparer.quote(stored[tuple(key.column_keys)]["name"])
+        columns = ", ".join(preparer.quote(column) for column in key.column_keys)
+        referred = ", ".join(preparer.quote(element.column.name) for element in key.elements)
+        connection.execute(text(
+            f"ALTER TABLE {name} DROP CONSTRAINT {constraint}, ADD CONSTRAINT {constraint} "
+            f"FOREIGN KEY ({columns}) REFERENCES {preparer.format_table(key.referred_table)} ({referred}) "
+            f"ON DELETE {key.ondelete} NOT VALID"
+        ))
+        connection.execute(text(f"ALTER TABLE {name} VALIDATE CONSTRAINT {constraint}"))
+
+
+def _rebuild_sqlite_table(connection, table):
+    """Recreates a SQLite table from its model, keeping its rows
+
+    The columns the table does not have yet are filled with their defaults.
+    """
+    preparer = connection.dialect.identifier_preparer
+    old = preparer.quote(f"_{table.name}_old")
+    existing = {column["name"] for column in inspect(connection).get_columns(table.name)}
+    columns = ", ".join(preparer.quote(column.name) for column in table.columns if column.name in existing)
+    connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} RENAME TO {old}"))
+    for index in table.indexes:
+        connection.execute(text(f"DROP INDEX IF EXISTS {preparer.quote(index.name)}"))
+    table.create(connection)
+    connection.execute(text(
+        f"INSERT INTO {preparer.format_table(table)} ({columns}) SELECT {columns} FROM {old}"
+    ))
+    connection.execute(text(f"DROP TABLE {old}"))
+
+
+######################################################################
+#  T E X T   S E A R C H
+######################################################################
+# The document Order.text_search matches on PostgreSQL, the name weighs more
+# than the address. A query must use this exact expression to use the index.
+ORDER_SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(address, '')), 'B')"
+)
+# On SQLite an FTS5 table indexes the name and address of the order table,
+# kept in sync by triggers since it only holds the index, not the text
+ORDER_SEARCH_TABLE = "order_search"
+SQLITE_SEARCH_TRIGGERS = {
+    "order_search_insert": (
+        'AFTER INSERT ON "order" BEGIN '
+        "INSERT INTO order_search(rowid, name, address) VALUES (new.id, new.name, new.address); END"
+    ),
+    "order_search_delete": (
+        'AFTER DELETE ON "order" BEGIN '
+        "INSERT INTO order_search(order_search, rowid, name, address) "
+        "VALUES ('delete', old.id, old.name, old.address); END"
+    ),
+    "order_search_update": (
+        'AFTER UPDATE OF name, address ON "order" BEGIN '
+        "INSERT INTO order_search(order_search, rowid, name, address) "
+        "VALUES ('delete', old.id, old.name, old.address); "
+        "INSERT INTO order_search(rowid, name, address) VALUES (new.id, new.name, new.address); END"
+    ),
+}
+
+
+def create_text_search(connection, concurrently=False):
+    """Creates the text search index over the name and address of the Orders
+
+    On PostgreSQL a GIN index on ORDER_SEARCH_VECTOR, built CONCURRENTLY when
+    asked (that needs an autocommit connection). On SQLite the FTS5 table and
+    its triggers, then the table is filled from the existing Orders.
+    """
+    if connection.dialect.name == "postgresql":
+        concurrent = "CONCURRENTLY " if concurrently else ""
+        connection.execute(text(
+            f'CREATE INDEX {concurrent}IF NOT EXISTS ix_order_search ON "order" '
+            f"USING gin (({ORDER_SEARCH_VECTOR}))"
+        ))
+        return
+    connection.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {ORDER_SEARCH_TABLE} "
+        "USING fts5(name, address, content='order', content_rowid='id')"
+    ))
+    for name, definition in SQLITE_SEARCH_TRIGGERS.items():
+        connection.execute(text(f"CREATE TRIGGER IF NOT EXISTS {name} {definition}"))
+    connection.execute(text(
+        f"INSERT INTO {ORDER_SEARCH_TABLE}({ORDER_SEARCH_TABLE}) VALUES ('rebuild')"
+    ))
+
+
+def drop_text_search(connection):
+    """Drops the text search index, see create_text_search"""
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("DROP INDEX IF EXISTS ix_order_search"))
+        return
+    for name in SQLITE_SEARCH_TRIGGERS:
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+    connection.execute(text(f"DROP TABLE IF EXISTS {ORDER_SEARCH_TABLE}"))
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+@migration(1, transactional=False)
+def add_query_indexes(connection, metadata):
+    """Index the columns the finders filter and page on"""
+    create_index(connection, metadata, "item", "ix_item_order_id_id")
+    create_index(connection, metadata, "item", "ix_item_price_order_id")
+    create_index(connection, metadata, "item", "ix_item_product_id")
+    create_index(connection, metadata, "order", "ix_order_date_created_id")
+    create_index(connection, metadata, "order", "ix_order_name")
+
+
+@migration(2)
+def add_product_summary(connection, metadata):
+    """Summarize the items of every product"""
+    summary = metadata.tables["product_summary"]
+    item = metadata.tables["item"]
+    summary.create(connection, checkfirst=True)
+    connection.execute(summary.delete())
+    connection.execute(summary.insert().from_select(
+        ["product_id", "item_count", "quantity", "revenue"],
+        select(
+            item.c.product_id,
+            func.count(item.c.id),
+            func.coalesce(func.sum(item.c.quantity), 0),
+            func.coalesce(func.sum(item.c.price * item.c.quantity), 0.0),
+        ).group_by(item.c.product_id),
+    ))
+
+
+@migration(3)
+def add_daily_rollups(connection, metadata):
+    """Roll up the orders of every day"""
+    rollup = metadata.tables["daily_rollup"]
+    daily_product = metadata.tables["daily_product"]
+    order = metadata.tables["order"]
+    item = metadata.tables["item"]
+    for table in (rollup, daily_product):
+        table.create(connection, checkfirst=True)
+        connection.execute(table.delete())
+    # one pass over the whole history, for very large tables empty the
+    # rollups instead and run flask rebuild-rollups, which works in batches
+    connection.execute(rollup.insert().from_select(
+        ["date_created", "orders", "items", "quantity", "revenue"],
+        select(
+            order.c.date_created, func.count(distinct(order.c.id)), func.count(item.c.id),
+            func.coalesce(func.sum(item.c.quantity), 0),
+            func.coalesce(func.sum(item.c.price * item.c.quantity), 0.0),
+        ).select_from(order.outerjoin(item, item.c.order_id == order.c.id)).
+        group_by(order.c.date_created),
+    ))
+    connection.execute(daily_product.insert().from_select(
+        ["date_created", "product_id", "items"],
+        select(order.c.date_created, item.c.product_id, func.count(item.c.id)).
+        select_from(order.join(item, item.c.order_id == order.c.id)).
+        group_by(order.c.date_created, item.c.product_id),
+    ))
+
+
+@migration(4)
+def add_order_version(connection, metadata):
+    """Version every order for conditional requests"""
+    add_column(connection, metadata, "order", "version")
+
+
+@migration(5, transactional=False)
+def add_order_text_search(connection, metadata):  # pylint: disable=unused-argument
+    """Index the name and address of the orders for text search"""
+    create_text_search(connection, concurrently=True)
+
+
+@migration(6, transactional=False)
+def cascade_item_deletes(connection, metadata):
+    """Delete the items of an order with the order"""
+    replace_foreign_keys(connection, metadata, "item")
+
+
+@migration(7, transactional=False)
+def add_order_status(connection, metadata):
+    """Give every order a status and index it with the time it changed"""
+    add_column(connection, metadata, "order", "status")
+    add_column(connection, metadata, "order", "status_changed_at")
+    create_index(connection, metadata, "order", "ix_order_status_changed")
+
+
+@migration(8)
+def add_order_events(connection, metadata):
+    """Record the changes to the orders and items in an outbox"""
+    for name in ("order_event", "event_cursor"):
+        metadata.tables[name].create(connection, checkfirst=True)
+
+
+@migration(9, transactional=False)
+def add_updated_at(connection, metadata):
+    """Track when every order and item last changed"""
+    add_column(connection, metadata, "order", "updated_at")
+    add_column(connection, metadata, "item", "updated_at")
+    create_index(connection, metadata, "order", "ix_order_updated_at_id")
+
+
+@migration(10)
+def add_idempotency_keys(connection, metadata):
+    """Store the responses of requests sent with an Idempotency-Key"""
+    metadata.tables["idempotency_key"].create(connection, checkfirst=True)
+
+
+@migration(11)
+def add_pending_events(connection, metadata):
+    """Stop serializing the writes appending events on PostgreSQL"""
+    metadata.tables["order_event_pending"].create(connection, checkfirst=True)
+
+
+@migration(12, transactional=False)
+def add_name_sort_index(connection, metadata):
+    """Index the name sort of the order search"""
+    create_index(connection, metadata, "order", "ix_order_name_sort_id")
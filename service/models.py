@@ -3,14 +3,67 @@ Models for YourResourceModel
 
 All of the models are stored in this module
 """
-from datetime import date
+from datetime import date, datetime, time, timedelta
 import logging
+import re
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from greenlet import getcurrent
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+from service import migrations
+from service.common.cache import order_cache
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# One session per greenlet: under the gevent worker every request runs in its
+# own greenlet of the same thread, so a thread scoped session would be shared
+db = SQLAlchemy(session_options={"scopefunc": getcurrent})
+
+
+@db.event.listens_for(Engine, "connect")
+def _enable_foreign_keys(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+    """Makes SQLite enforce foreign keys, and so ON DELETE CASCADE, like PostgreSQL"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys = ON")
+        cursor.close()
+
+
+# Ways of loading Order.items eagerly so serializing many Orders does not
+# issue one SELECT per Order:
+#   selectin - one extra SELECT ... WHERE order_id IN (...) per batch of Orders,
+#              best for lists since the Order rows are not duplicated
+#   joined   - a LEFT OUTER JOIN in the same SELECT, best for a single Order
+ITEM_LOADERS = {
+    "selectin": selectinload,
+    "joined": joinedload,
+}
+
+# Rows sent in one multi-row INSERT, keeps the bind parameters per statement
+# well under the limits of the database drivers
+ROWS_PER_INSERT = 1000
+# Order ids per SELECT ... WHERE order_id IN (...) when fetching Items by rows,
+# and Item ids per statement when changing Items in batches
+IDS_PER_SELECT = 500
+# The columns of an Item Order.change_items can change
+ITEM_CHANGE_COLUMNS = ("status", "quantity", "price")
+
+# The status of an Order -> the statuses it may move to, see Order.change_status
+ORDER_TRANSITIONS = {
+    "open": ("shipped", "cancelled"),
+    "shipped": ("delivered",),
+    "delivered": (),
+    "cancelled": (),
+}
+# updated_at of the rows written before it was tracked
+UPDATED_AT_UNKNOWN = "1970-01-01 00:00:00"
+# Words of a text search, a longer text is cut so one query stays cheap
+SEARCH_WORD = re.compile(r"\w+")
+MAX_SEARCH_WORDS = 8
 
 
 class DataValidationError(Exception):
@@ -32,8 +85,20 @@ class Item(db.Model):
     product_id = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
     quantity = db.Column(db.Integer, nullable=False, default=1)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    # the database deletes the Items of a deleted Order, see Order.delete_many
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id', ondelete="CASCADE"))
     status = db.Column(db.String, nullable=False)
+    # set by every write of the Item, rows older than the column have the epoch
+    updated_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=UPDATED_AT_UNKNOWN)
+
+    # Indexes on the columns the finders filter on. A new index must also be
+    # added as a migration in service/migrations.py for existing databases.
+    __table_args__ = (
+        db.Index("ix_item_order_id_id", "order_id", "id"),
+        db.Index("ix_item_price_order_id", "price", "order_id"),
+        db.Index("ix_item_product_id", "product_id"),
+    )
 
     # Remark: Remove constructor according to consistent implementation with:
     #         https://github.com/nyu-devops/lab-flask-tdd/blob/master/service/models.py
@@ -51,25 +116,31 @@ class Item(db.Model):
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
         db.session.commit()
+        order_cache.invalidate(self.order_id)
 
     def update(self):
         """
         Updates an Item to the database
         """
         logger.info("Saving %s", self.id)
+        order_id = self.order_id
         db.session.commit()
+        order_cache.invalidate(order_id)
 
     def delete(self):
         """ Removes an Item from the data store """
         logger.info("Deleting %s", self.id)
+        order_id = self.order_id
         db.session.delete(self)
         db.session.commit()
+        order_cache.invalidate(order_id)
 
     def serialize(self):
         """ Serializes a Item into a dictionary """
         return {
             "id": self.id, "product_id": self.product_id, "price": self.price,
-            "quantity": self.quantity, "order_id": self.order_id, "status": self.status
+            "quantity": self.quantity, "order_id": self.order_id, "status": self.status,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
 
     def deserialize(self, data):
@@ -99,8 +170,7 @@ class Item(db.Model):
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.drop_all()
-        db.create_all()  # make our sqlalchemy tables
+        migrations.upgrade(db)  # make our sqlalchemy tables
 
     @classmethod
     def all(cls):
@@ -114,6 +184,30 @@ class Item(db.Model):
         logger.info("Processing lookup for id %s ...", by_id)
         return cls.query.get(by_id)
 
+    @classmethod
+    def find_in_order(cls, order_id, item_id):
+        """Finds an Item of an Order and whether the Order exists in one query
+
+        The Order is outer joined to the Item on the (order_id, id) index, so
+        an Item of another Order is not found.
+
+        :param order_id: the id of the Order
+        :type order_id: int
+
+        :param item_id: the id of the Item
+        :type item_id: int
+
+        :return: whether the Order exists, and the Item or None
+        :rtype: tuple
+        """
+        logger.info("Processing lookup for Item %s of Order %s ...", item_id, order_id)
+        row = db.session.query(Order.id, cls).select_from(Order).outerjoin(
+            cls, db.and_(cls.order_id == Order.id, cls.id == item_id)
+        ).filter(Order.id == order_id).first()
+        if row is None:
+            return False, None
+        return True, row[1]
+
     @classmethod
     def find_by_product_id(cls, product_id):
         """Returns all Item with the given order_id
@@ -135,15 +229,21 @@ class Item(db.Model):
         return cls.query.filter(cls.order_id == order_id)
 
     @classmethod
-    def find_by_price(cls, max_price, min_price):
+    def find_by_price(cls, max_price, min_price, after_id=None, limit=None):
         """Returns all Items within the price range
 
         Args:
-            name (string): the max and min price
+            max_price (float): the maximal price
+            min_price (float): the minimal price
+            after_id (int): only Items with an id greater than this are returned
+            limit (int): the maximum number of Items to return
         """
         logger.info("Processing price query for %s %s...", max_price, min_price)
-        return cls.query.filter(cls.price <= max_price).\
+        query = cls.query.filter(cls.price <= max_price).\
             filter(cls.price >= min_price)
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        return query.order_by(cls.id).limit(limit)
 
 
 class Order(db.Model):
@@ -162,7 +262,24 @@ class Order(db.Model):
     # user_id = db.Column(db.Integer, nullable=False)
     address = db.Column(db.String(127), default="Invalid Address")
     date_created = db.Column(db.Date(), nullable=False, default=date.today())
-    items = db.relationship("Item", backref="order", passive_deletes=True)
+    # bumped by every change to the Order or its Items, see _bump_versions
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # one of ORDER_TRANSITIONS, only ever changed through change_status
+    status = db.Column(db.String(16), nullable=False, default="open", server_default="open")
+    status_changed_at = db.Column(db.DateTime())
+    # set with the version, by every change to the Order or its Items
+    updated_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=UPDATED_AT_UNKNOWN)
+    items = db.relationship("Item", backref="order", passive_deletes=True, order_by="Item.id")
+
+    # Indexes on the columns the finders filter on. A new index must also be
+    # added as a migration in service/migrations.py for existing databases.
+    __table_args__ = (
+        db.Index("ix_order_date_created_id", "date_created", "id"),
+        db.Index("ix_order_name", "name"),
+        db.Index("ix_order_status_changed", "status", "status_changed_at", "id"),
+        db.Index("ix_order_updated_at_id", "updated_at", "id"),
+    )
 
     def __repr__(self):
         return f"<name=[{self.name}]\t \
@@ -182,15 +299,18 @@ class Order(db.Model):
         update an Order to database
         """
         logger.info("Saving %s", self.name)
+        order_id = self.id
         db.session.commit()
+        order_cache.invalidate(order_id)
 
     def delete(self):
         """
-        Removes an Order from the data store
+        Removes an Order and its Items from the data store, see delete_many
         """
         logger.info("Deleting %s", self.name)
-        db.session.delete(self)
-        db.session.commit()
+        order_id = self.id
+        db.session.expunge(self)
+        self.delete_many([order_id])
 
     def serialize(self):
         """
@@ -201,12 +321,264 @@ class Order(db.Model):
             "name": self.name,
             "address": self.address,
             "date_created": self.date_created.isoformat(),
+            "version": self.version,
+            "status": self.status,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
             "items": []
         }
         for item in self.items:
             order["items"].append(item.serialize())
         return order
 
+    @classmethod
+    def bulk_create(cls, orders):
+        """Inserts many new Orders and their Items in a single transaction
+
+        The rows are written with multi-row INSERT statements instead of one
+        INSERT per object. The ids are allocated up front and set on the
+        Orders and Items passed in. Nothing is stored if any row fails.
+
+        :param orders: new Orders, as returned by deserialize
+        :type orders: list
+
+        """
+        logger.info("Bulk creating %d orders", len(orders))
+        items = [item for order in orders for item in order.items]
+        now = datetime.utcnow()
+        try:
+            order_rows = []
+            for order, order_id in zip(orders, _allocate_ids(cls, len(orders))):
+                order.id = order_id
+                order_rows.append({
+                    "id": order.id, "name": order.name, "address": order.address,
+                    "date_created": order.date_created or date.today(), "version": 1,
+                    "status": "open", "status_changed_at": None, "updated_at": now,
+                })
+            item_rows = []
+            for item, item_id in zip(items, _allocate_ids(Item, len(items))):
+                item.id = item_id
+                item.order_id = item.order.id
+                item_rows.append({
+                    "id": item.id, "product_id": item.product_id, "price": item.price,
+                    "quantity": item.quantity, "order_id": item.order_id, "status": item.status,
+                    "updated_at": now,
+                })
+            _insert_rows(cls.__table__, order_rows)
+            _insert_rows(Item.__table__, item_rows)
+            _add_to_product_summary(db.session.connection(), _product_deltas(
+                (row["product_id"], row["quantity"], row["price"], 1) for row in item_rows
+            ))
+            _add_to_rollups(db.session.connection(), _order_contributions(
+                db.session, [row["id"] for row in order_rows]
+            ))
+            _append_events(db.session.connection(), [
+                ("order", row["id"], row["id"], "created", _json_row(row)) for row in order_rows
+            ] + [
+                ("item", row["id"], row["order_id"], "created", _json_row(row)) for row in item_rows
+            ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def change_items(cls, order_id, updates, deletes):
+        """Changes and deletes many Items of an Order in a single transaction
+
+        The Items are written with set-based statements, one UPDATE setting
+        every column with a CASE on the Item id and one DELETE per
+        IDS_PER_SELECT Items, instead of loading and flushing every Item. The
+        product summary, the daily rollups and the version of the Order are
+        brought up to date in the same transaction. Ids of Items that are not
+        in the Order are left alone.
+
+        :param order_id: the id of the Order
+        :type order_id: int
+
+        :param updates: the new values by Item id, of the ITEM_CHANGE_COLUMNS
+        :type updates: dict
+
+        :param deletes: the ids of the Items to delete
+        :type deletes: set
+
+        :return: the ids of the Items changed or deleted and the version of
+                 the Order, or None if the Order does not exist
+        :rtype: tuple
+        """
+        logger.info("Changing %d and deleting %d items of order %s", len(updates), len(deletes), order_id)
+        table = Item.__table__
+        try:
+            version = cls.find_version(order_id, lock=True)
+            if version is None:
+                db.session.rollback()
+                return None
+            connection = db.session.connection()
+            ids = sorted(set(updates) | set(deletes))
+            rows = {}
+            for start in range(0, len(ids), IDS_PER_SELECT):
+                for row in connection.execute(
+                    table.select().
+                    where(table.c.order_id == order_id, table.c.id.in_(ids[start:start + IDS_PER_SELECT])).
+                    with_for_update()
+                ):
+                    rows[row.id] = _json_row(row._mapping)  # pylint: disable=protected-access
+            stored = {item_id: (row["product_id"], row["quantity"], row["price"]) for item_id, row in rows.items()}
+            if not stored:
+                db.session.rollback()
+                return set(), version
+
+            before = _order_contributions(db.session, [order_id])
+            updated = [item_id for item_id in sorted(updates) if item_id in stored and item_id not in deletes]
+            deleted = [item_id for item_id in sorted(deletes) if item_id in stored]
+            now = datetime.utcnow()
+            _write_item_changes(connection, {item_id: updates[item_id] for item_id in updated}, deleted, now)
+
+            changes = [stored[item_id] + (-1,) for item_id in updated + deleted]
+            for item_id in updated:
+                product_id, quantity, price = stored[item_id]
+                new = updates[item_id]
+                changes.append((product_id, new.get("quantity", quantity), new.get("price", price), 1))
+            _add_to_product_summary(connection, _product_deltas(changes))
+            _add_to_rollups(connection, _rollup_deltas(_order_contributions(db.session, [order_id]), before))
+            order = cls.__table__
+            connection.execute(order.update().where(order.c.id == order_id).values(version=order.c.version + 1))
+            _append_events(connection, [
+                ("item", item_id, order_id, "updated", dict(rows[item_id], **updates[item_id], updated_at=now.isoformat()))
+                for item_id in updated
+            ] + [("item", item_id, order_id, "deleted", None) for item_id in deleted])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        order_cache.invalidate(order_id)
+        return set(stored), version + 1
+
+    @classmethod
+    def change_status(cls, order_id, new_status):
+        """Moves an Order to a new status if ORDER_TRANSITIONS allows it
+
+        The transition is checked and made by a single UPDATE guarded by the
+        statuses the Order may come from, so two concurrent requests can not
+        both move it. The version of the Order is bumped with its status.
+
+        :param order_id: the id of the Order
+        :type order_id: int
+
+        :param new_status: the status to move the Order to
+        :type new_status: str
+
+        :return: the status of the Order afterwards, it is not new_status when
+            the transition is not allowed, or None if the Order does not exist
+        :rtype: str
+        """
+        sources = [old for old, targets in ORDER_TRANSITIONS.items() if new_status in targets]
+        order = cls.__table__
+        try:
+            changed = db.session.connection().execute(
+                order.update().where(order.c.id == order_id, order.c.status.in_(sources)).
+                values(status=new_status, status_changed_at=datetime.utcnow(), version=order.c.version + 1)
+            ).rowcount
+            if not changed:
+                current = db.session.query(cls.status).filter(cls.id == order_id).scalar()
+                db.session.rollback()
+                return current
+            _append_events(db.session.connection(), [("order", order_id, order_id, "updated", None)])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        logger.info("Order [%s] is now %s", order_id, new_status)
+        order_cache.invalidate(order_id)
+        return new_status
+
+    @classmethod
+    def delete_many(cls, order_ids):
+        """Deletes Orders and their Items in a single transaction
+
+        The Orders are deleted with one DELETE per IDS_PER_SELECT Orders and
+        the database deletes their Items through ON DELETE CASCADE, no Order
+        or Item is loaded. What they added to the product summary and the
+        daily rollups is taken off in the same transaction.
+
+        :param order_ids: the ids of the Orders to delete
+        :type order_ids: iterable
+
+        :return: the ids of the Orders that existed and were deleted
+        :rtype: list
+        """
+        ids = sorted({int(order_id) for order_id in order_ids})
+        logger.info("Deleting %d orders", len(ids))
+        table, items = cls.__table__, Item.__table__
+        deleted = []
+        try:
+            connection = db.session.connection()
+            for start in range(0, len(ids), IDS_PER_SELECT):
+                found = [row.id for row in connection.execute(
+                    db.select(table.c.id).where(table.c.id.in_(ids[start:start + IDS_PER_SELECT])).with_for_update()
+                )]
+                if not found:
+                    continue
+                contributions = _order_contributions(db.session, found)
+                products = connection.execute(
+                    db.select(
+                        items.c.product_id, db.func.count(items.c.id), db.func.sum(items.c.quantity),
+                        db.func.sum(items.c.price * items.c.quantity),
+                    ).where(items.c.order_id.in_(found)).group_by(items.c.product_id)
+                )
+                deltas = {product_id: (-count, -quantity, -revenue) for product_id, count, quantity, revenue in products}
+                connection.execute(table.delete().where(table.c.id.in_(found)))
+                _add_to_product_summary(connection, deltas)
+                _add_to_rollups(connection, _rollup_deltas(({}, {}), contributions))
+                deleted.extend(found)
+            _append_events(connection, [("order", order_id, order_id, "deleted", None) for order_id in deleted])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for order_id in deleted:
+            order_cache.invalidate(order_id)
+        return deleted
+
+    @classmethod
+    def purge(cls, start=None, end=None, batch_size=1000, archive=None, max_batches=None):
+        """Deletes the Orders created from start to end, batch_size at a time
+
+        Every batch is deleted in its own short transaction (see delete_many),
+        so purging years of Orders never locks them all at once and can be
+        stopped and started again.
+
+        :param start: the first date_created to delete, a date
+        :param end: the last date_created to delete, a date
+
+        :param batch_size: the number of Orders deleted per transaction
+        :type batch_size: int
+
+        :param archive: called with every batch of serialized Orders before
+                        it is deleted, an error stops the purge
+        :type archive: function
+
+        :param max_batches: stop after this many batches, all of them when None
+        :type max_batches: int
+
+        :return: the number of Orders deleted
+        :rtype: int
+        """
+        logger.info("Purging orders from %s to %s by %d", start, end, batch_size)
+        total = batches = 0
+        while max_batches is None or batches < max_batches:
+            query = cls.filtered(start=start, end=end).with_entities(cls.id).\
+                order_by(cls.date_created, cls.id).limit(batch_size)
+            ids = [row.id for row in query]
+            if not ids:
+                return total
+            if archive is not None:
+                archive(cls.serialize_rows(cls.query.filter(cls.id.in_(ids)).order_by(cls.date_created, cls.id)))
+            total += len(cls.delete_many(ids))
+            batches += 1
+            if len(ids) < batch_size:
+                return total
+        return total
+
     def deserialize(self, data):
         """
         Deserializes a Order from a dictionary
@@ -248,7 +620,27 @@ class Order(db.Model):
         Item.app = app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()
+        migrations.upgrade(db)
+
+    @classmethod
+    def with_items(cls, query=None, strategy="selectin"):
+        """Shapes a query so the items of every Order are loaded eagerly
+
+        :param query: the Order query to shape, defaults to all Orders
+        :type query: Query
+
+        :param strategy: one of ITEM_LOADERS, or None to keep lazy loading
+        :type strategy: str
+
+        :return: the shaped query
+        :rtype: Query
+
+        """
+        if query is None:
+            query = cls.query
+        if strategy is None:
+            return query
+        return query.options(ITEM_LOADERS[strategy](cls.items))
 
     @classmethod
     def all(cls):
@@ -259,17 +651,339 @@ class Order(db.Model):
         return cls.query.all()
 
     @classmethod
-    def find(cls, by_id):
+    def serialize_rows(cls, query):
+        """Runs an Order query and serializes the Orders straight from the rows
+
+        Only the columns are selected, no Order or Item objects are built or
+        added to the session. The Items are fetched with one SELECT ... WHERE
+        order_id IN (...) per IDS_PER_SELECT Orders, like selectin loading.
+
+        :param query: the Order query, in the order of the results
+        :type query: Query
+
+        :return: the Orders as serialize() returns them
+        :rtype: list
+
+        """
+        orders = []
+        by_id = {}
+        for order_id, name, address, date_created, version, order_status, updated_at in query.with_entities(
+                cls.id, cls.name, cls.address, cls.date_created, cls.version, cls.status, cls.updated_at):
+            order = {
+                "id": order_id, "name": name, "address": address,
+                "date_created": date_created.isoformat(), "version": version,
+                "status": order_status, "updated_at": updated_at.isoformat(), "items": []
+            }
+            orders.append(order)
+            by_id[order_id] = order
+        ids = list(by_id)
+        for start in range(0, len(ids), IDS_PER_SELECT):
+            rows = db.session.query(
+                Item.id, Item.product_id, Item.price, Item.quantity, Item.order_id, Item.status, Item.updated_at
+            ).filter(Item.order_id.in_(ids[start:start + IDS_PER_SELECT])).order_by(Item.order_id, Item.id)
+            for item_id, product_id, price, quantity, order_id, item_status, updated_at in rows:
+                by_id[order_id]["items"].append({
+                    "id": item_id, "product_id": product_id, "price": price,
+                    "quantity": quantity, "order_id": order_id, "status": item_status,
+                    "updated_at": updated_at.isoformat(),
+                })
+        return orders
+
+    @classmethod
+    def changes(cls, after_event, limit=None):
+        """Returns the Orders changed and deleted after a change event
+
+        The events are read in id order, and ids are only handed out to the
+        events of committed transactions (see OrderEvent.sequence), so reading
+        on from the last event returned never misses a change. An Order
+        changed several times is returned once.
+
+        :param after_event: the id of the last OrderEvent already synced
+        :type after_event: int
+
+        :param limit: the maximum number of events to read
+        :type limit: int
+
+        :return: the serialized Orders that changed, the ids of the deleted
+                 Orders, the id of the last event read and whether there may
+                 be more events
+        :rtype: tuple
+        """
+        OrderEvent.sequence()
+        events = db.session.query(OrderEvent.id, OrderEvent.order_id, OrderEvent.entity, OrderEvent.action).\
+            filter(OrderEvent.id > after_event).order_by(OrderEvent.id).limit(limit).all()
+        deleted = {event.order_id for event in events if event.entity == "order" and event.action == "deleted"}
+        changed = sorted({event.order_id for event in events} - deleted)
+        orders = []
+        for start in range(0, len(changed), IDS_PER_SELECT):
+            orders.extend(cls.serialize_rows(
+                cls.query.filter(cls.id.in_(changed[start:start + IDS_PER_SELECT])).order_by(cls.id)
+            ))
+        last = events[-1].id if events else after_event
+        return orders, sorted(deleted), last, limit is not None and len(events) == limit
+
+    @classmethod
+    def filtered(cls, **filters):
+        """Returns a query of the Orders matching all of the given filters
+
+        The Item filters select the Orders having at least one Item matching
+        all of them, with a single EXISTS subquery. Filters set to None are
+        left out.
+
+        :param name: the name of the Orders
+        :param start: the first date_created, a date
+        :param end: the last date_created, a date
+        :param order_status: the status of the Orders
+        :param status_since: the first day the Orders got that status, a date
+        :param updated_since: only the Orders changed after this datetime
+        :param product_id: the product of one of the Items
+        :param min_price: the minimal price of that Item
+        :param max_price: the maximal price of that Item
+        :param status: the status of that Item
+
+        :return: the Orders query
+        :rtype: Query
+        """
+        query = cls.query
+        item_filters = []
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name in ORDER_FILTERS:
+                query = query.filter(ORDER_FILTERS[name](value))
+            else:
+                item_filters.append(ITEM_FILTERS[name](value))
+        if item_filters:
+            query = query.filter(cls.items.any(db.and_(*item_filters)))
+        return query
+
+    @classmethod
+    def search(cls, filters=None, sort="id", after=None, limit=None):
+        """Returns one page of serialized Orders matching filters, in sort order
+
+        Pages are cut with keyset pagination on (sort key, id), which the
+        index on (date_created, id) serves for the date_created sort.
+
+        :param filters: the keyword arguments of filtered()
+        :type filters: dict
+
+        :param sort: one of ORDER_SORTS, with a leading "-" for descending
+        :type sort: str
+
+        :param after: the sort_cursor() of the last Order of the previous page
+        :type after: tuple
+
+        :param limit: the maximum number of Orders to return
+        :type limit: int
+
+        :return: the Orders as serialize() returns them
+        :rtype: list
+        """
+        logger.info("Processing search %s sorted by %s after %s limit %s ...", filters, sort, after, limit)
+        descending = sort.startswith("-")
+        key, _ = ORDER_SORTS[sort.lstrip("-")]
+        query = cls.filtered(**(filters or {}))
+        columns = [cls.id] if key is cls.id else [key, cls.id]
+        if after is not None:
+            value, last_id = after
+            row = db.tuple_(*columns)
+            bound = db.tuple_(*([last_id] if key is cls.id else [value, last_id]))
+            query = query.filter(row < bound if descending else row > bound)
+        query = query.order_by(*[column.desc() if descending else column for column in columns])
+        return cls.serialize_rows(query.limit(limit))
+
+    @classmethod
+    def sort_cursor(cls, order, sort="id"):
+        """Returns the (sort key, id) of a serialized Order, to pass as after"""
+        _, value_of = ORDER_SORTS[sort.lstrip("-")]
+        return value_of(order), order["id"]
+
+    @classmethod
+    def iter_search_batches(cls, filters=None, sort="id", after=None, batch_size=500):
+        """Iterates over all Orders of a search, one page at a time
+
+        :return: a generator of lists of serialized Orders
+        :rtype: generator
+        """
+        while True:
+            batch = cls.search(filters, sort, after, batch_size)
+            if not batch:
+                return
+            after = cls.sort_cursor(batch[-1], sort)
+            yield batch
+            if len(batch) < batch_size:
+                return
+
+    @classmethod
+    def search_words(cls, text):
+        """Returns the words of a text search, lower cased"""
+        return SEARCH_WORD.findall(text.lower())[:MAX_SEARCH_WORDS]
+
+    @classmethod
+    def text_matches(cls, words):
+        """Returns the query of the Orders matching words and the SQL expression of their rank
+
+        :param words: the words to match, see search_words()
+        :type words: list
+
+        :return: the Orders query and the rank, higher for better matches
+        :rtype: tuple
+        """
+        if db.engine.dialect.name == "postgresql":
+            document = db.literal_column(f"({migrations.ORDER_SEARCH_VECTOR})")
+            terms = db.func.to_tsquery("simple", " & ".join(f"'{word}':*" for word in words))
+            # as double precision so the rank in a page token compares equal
+            rank = db.cast(db.func.ts_rank(document, terms), db.Float)
+            query = cls.query.filter(document.op("@@")(terms))
+        else:
+            search = db.table(migrations.ORDER_SEARCH_TABLE, db.column("rowid"))
+            index = db.literal_column(migrations.ORDER_SEARCH_TABLE)
+            # bm25 is lower for better matches, the name column weighs ten times more
+            rank = -db.func.bm25(index, 10.0, 1.0)
+            query = cls.query.join(search, search.c.rowid == cls.id).\
+                filter(index.op("MATCH")(" ".join(f'"{word}"*' for word in words)))
+        return query, rank
+
+    @classmethod
+    def text_search(cls, words, after=None, limit=None):
+        """Returns one page of serialized Orders whose name or address match words
+
+        Every word must be the start of a word of the name or of the address,
+        so "smi" finds "Smith". The Orders come best match first, a match in
+        the name ranks above one in the address, and each one gets its "rank".
+        Only the matching Orders are ranked, they are found through the text
+        index (see create_text_search in service/migrations.py).
+
+        :param words: the words to match, see search_words()
+        :type words: list
+
+        :param after: the (rank, id) of the last Order of the previous page
+        :type after: tuple
+
+        :param limit: the maximum number of Orders to return
+        :type limit: int
+
+        :return: the Orders as serialize() returns them, with their rank
+        :rtype: list
+        """
+        logger.info("Processing text search %s after %s limit %s ...", words, after, limit)
+        if not words:
+            return []
+        query, rank = cls.text_matches(words)
+        if after is not None:
+            last_rank, last_id = after
+            query = query.filter(db.or_(rank < last_rank, db.and_(rank == last_rank, cls.id > last_id)))
+        ranked = query.with_entities(cls.id, rank.label("rank")).\
+            order_by(rank.desc(), cls.id).limit(limit).all()
+        orders = {
+            order["id"]: order
+            for order in cls.serialize_rows(cls.query.filter(cls.id.in_([row[0] for row in ranked])))
+        }
+        results = []
+        for order_id, order_rank in ranked:
+            orders[order_id]["rank"] = order_rank
+            results.append(orders[order_id])
+        return results
+
+    @classmethod
+    def find(cls, by_id, items=None):
         """Finds a Order by it's ID
 
         :param order_id: the id of the Order to find
         :type order_id: int
 
+        :param items: how to load the items of the Order, see ITEM_LOADERS
+        :type items: str
+
         :return: an instance with the order_id, or None if not found
         :rtype: Pet
         """
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        return cls.with_items(strategy=items).get(by_id)
+
+    @classmethod
+    def find_serialized(cls, by_id):
+        """Finds an Order by it's ID and returns it serialized
+
+        The result is read through the order cache. It is shared with other
+        requests and must not be modified.
+
+        :param by_id: the id of the Order to find
+        :type by_id: int
+
+        :return: the serialized Order, or None if not found
+        :rtype: dict
+        """
+        data = order_cache.get(by_id)
+        if data is None:
+            # a write committed while the Order is read cancels the reservation
+            token = order_cache.reserve(by_id)
+            order = cls.find(by_id, items="joined")
+            if order is None:
+                return None
+            data = order.serialize()
+            order_cache.set(order.id, data, token)
+        return data
+
+    @classmethod
+    def find_version(cls, by_id, lock=False):
+        """Returns the version of an Order without loading it
+
+        The version is always read from the database, never from the order
+        cache, which may be behind another worker. With lock the row is read
+        with FOR UPDATE, so the version can not change before the transaction
+        ends.
+
+        :param by_id: the id of the Order
+        :type by_id: int
+
+        :param lock: whether to lock the Order until the transaction ends
+        :type lock: bool
+
+        :return: the version, or None if the Order does not exist
+        :rtype: int
+        """
+        query = db.session.query(cls.version).filter(cls.id == by_id)
+        if lock:
+            query = query.with_for_update()
+        return query.scalar()
+
+    @classmethod
+    def find_by_price(cls, max_price, min_price, after_id=None, limit=None):
+        """Returns the Orders having Items within the price range
+
+        Each Order only carries its matching Items. The Orders and their
+        Items are fetched together in a single joined query.
+
+        :param max_price: the maximal price of the Items
+        :type max_price: float
+
+        :param min_price: the minimal price of the Items
+        :type min_price: float
+
+        :param after_id: only Orders with an id greater than this are returned
+        :type after_id: int
+
+        :param limit: the maximum number of Orders to return
+        :type limit: int
+
+        :return: the matching Orders in id order
+        :rtype: list
+
+        """
+        logger.info("Processing price query for %s %s...", max_price, min_price)
+        in_range = db.and_(Item.price <= max_price, Item.price >= min_price)
+        query = cls.query.join(cls.items).filter(in_range)
+        if after_id is not None or limit is not None:
+            # page on the Orders, not on the joined Order x Item rows
+            page = db.session.query(cls.id).filter(cls.items.any(in_range))
+            if after_id is not None:
+                page = page.filter(cls.id > after_id)
+            page = page.order_by(cls.id).limit(limit).subquery()
+            query = query.filter(cls.id.in_(db.select(page.c.id)))
+        # the collections are partial, so never merge them into cached Orders
+        return query.options(contains_eager(cls.items)).populate_existing().\
+            order_by(cls.id, Item.id).all()
 
     @classmethod
     def find_by_name(cls, name):
@@ -286,16 +1000,995 @@ class Order(db.Model):
         return cls.query.filter(cls.name == name)
 
     @classmethod
-    def find_by_date(cls, date_iso):
+    def find_by_date(cls, date_iso, items=None):
         """Returns all Orders with the given date
 
         :param name: the date of the Orders you want to match
         :type date: str
 
+        :param items: how to load the items of the Orders, see ITEM_LOADERS
+        :type items: str
+
         :return: a collection of Orders placed on that date
         :rtype: list
 
         """
 
         logger.info("Processing date query for date %s ...", date.fromisoformat(date_iso))
-        return cls.query.filter(cls.date_created == date.fromisoformat(date_iso))
+        query = cls.query.filter(cls.date_created == date.fromisoformat(date_iso))
+        return cls.with_items(query, items)
+
+    @classmethod
+    def find_by_date_serialized(cls, date_iso):
+        """Returns all Orders with the given date serialized, see find_by_date"""
+        logger.info("Processing serialized date query for date %s ...", date_iso)
+        query = cls.query.filter(cls.date_created == date.fromisoformat(date_iso))
+        return cls.serialize_rows(query.order_by(cls.id))
+
+    @classmethod
+    def totals(cls, after_id=None, limit=None, order_id=None):
+        """Returns the number of Items, the quantity and the total of Orders
+
+        The totals are computed by the database with a GROUP BY, so no Item
+        row is sent to the service. Orders without Items have a total of 0.
+
+        :param after_id: only Orders with an id greater than this are returned
+        :type after_id: int
+
+        :param limit: the maximum number of Orders to return
+        :type limit: int
+
+        :param order_id: only return the totals of this Order
+        :type order_id: int
+
+        :return: rows of order_id, item_count, quantity and total in id order
+        :rtype: list
+
+        """
+        logger.info("Processing totals query after id %s limit %s ...", after_id, limit)
+        query = db.session.query(
+            cls.id.label("order_id"),
+            db.func.count(Item.id).label("item_count"),
+            db.func.coalesce(db.func.sum(Item.quantity), 0).label("quantity"),
+            db.func.coalesce(db.func.sum(Item.price * Item.quantity), 0.0).label("total"),
+        ).outerjoin(Item, Item.order_id == cls.id)
+        if order_id is not None:
+            query = query.filter(cls.id == order_id)
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        return query.group_by(cls.id).order_by(cls.id).limit(limit).all()
+
+
+# Orders without a name sort as an empty name on every database. The literal,
+# rather than a bound parameter, lets SQLite match the expression of the index.
+ORDER_NAME_SORT = db.func.coalesce(Order.name, db.literal_column("''"))
+db.Index("ix_order_name_sort_id", ORDER_NAME_SORT, Order.id)
+
+# The sort keys of Order.search: name -> (SQL expression, value of a serialized Order)
+ORDER_SORTS = {
+    "id": (Order.id, lambda order: order["id"]),
+    "date_created": (Order.date_created, lambda order: date.fromisoformat(order["date_created"])),
+    "name": (ORDER_NAME_SORT, lambda order: order["name"] or ""),
+    "updated_at": (Order.updated_at, lambda order: datetime.fromisoformat(order["updated_at"])),
+}
+
+
+# The text search index is not declared on the table, it comes and goes with it
+@db.event.listens_for(Order.__table__, "after_create")
+def _create_text_search(table, connection, **kwargs):  # pylint: disable=unused-argument
+    migrations.create_text_search(connection)
+
+
+@db.event.listens_for(Order.__table__, "before_drop")
+def _drop_text_search(table, connection, **kwargs):  # pylint: disable=unused-argument
+    migrations.drop_text_search(connection)
+
+
+# The filters of Order.filtered: name -> function of the value returning the SQL condition
+ORDER_FILTERS = {
+    "name": lambda name: Order.name == name,
+    "start": lambda start: Order.date_created >= start,
+    "end": lambda end: Order.date_created <= end,
+    "order_status": lambda order_status: Order.status == order_status,
+    "status_since": lambda day: Order.status_changed_at >= datetime.combine(day, time()),
+    "updated_since": lambda since: Order.updated_at > since,
+}
+# the conditions one Item of the Orders must meet together
+ITEM_FILTERS = {
+    "product_id": lambda product_id: Item.product_id == product_id,
+    "min_price": lambda min_price: Item.price >= min_price,
+    "max_price": lambda max_price: Item.price <= max_price,
+    "status": lambda item_status: Item.status == item_status,
+}
+
+
+class ProductSummary(db.Model):
+    """
+    Running totals of the Items of every product
+
+    The rows are kept up to date by every flush that adds, changes or removes
+    Items (see S U M M A R Y   T A B L E S below), so reports by product read
+    one row per product instead of scanning the item table.
+    """
+
+    __tablename__ = "product_summary"
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        db.Index("ix_product_summary_revenue", "revenue", "product_id"),
+    )
+
+    def serialize(self):
+        """ Serializes a ProductSummary into a dictionary """
+        return {
+            "product_id": self.product_id, "item_count": self.item_count,
+            "quantity": self.quantity, "revenue": self.revenue
+        }
+
+    @classmethod
+    def find(cls, product_id):
+        """ Finds the ProductSummary of a product """
+        return cls.query.get(product_id)
+
+    @classmethod
+    def top(cls, after=None, limit=None):
+        """Returns the products with the highest revenue first
+
+        :param after: (revenue, product_id) of the last product seen
+        :type after: tuple
+
+        :param limit: the maximum number of products to return
+        :type limit: int
+
+        :return: a page of ProductSummary
+        :rtype: list
+
+        """
+        logger.info("Processing top products query after %s limit %s ...", after, limit)
+        query = cls.query.filter(cls.item_count > 0)
+        if after is not None:
+            query = query.filter(db.tuple_(cls.revenue, cls.product_id) < tuple(after))
+        return query.order_by(cls.revenue.desc(), cls.product_id.desc()).limit(limit).all()
+
+
+class DailyRollup(db.Model):
+    """
+    Running totals of the Orders created on every day
+
+    Kept up to date by every flush that writes Orders or Items, like
+    ProductSummary, so reports by day read one row per day. rebuild()
+    recomputes them from the order and item tables.
+    """
+
+    __tablename__ = "daily_rollup"
+
+    date_created = db.Column(db.Date(), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    items = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+    @classmethod
+    def find_range(cls, start=None, end=None, after_date=None, limit=None):
+        """Returns the totals of every day with Orders in a date range
+
+        :param start: the first day to report, unbounded when None
+        :type start: date
+
+        :param end: the last day to report, unbounded when None
+        :type end: date
+
+        :param after_date: only days after this one are returned
+        :type after_date: date
+
+        :param limit: the maximum number of days to return
+        :type limit: int
+
+        :return: rows of date, orders, items, quantity, revenue and
+                 distinct_products by date
+        :rtype: list
+
+        """
+        logger.info("Processing daily rollup query from %s to %s ...", start, end)
+        distinct_products = db.select(db.func.count()).where(
+            DailyProduct.date_created == cls.date_created
+        ).scalar_subquery()
+        query = db.session.query(
+            cls.date_created.label("date"), cls.orders, cls.items, cls.quantity, cls.revenue,
+            distinct_products.label("distinct_products"),
+        ).filter(cls.orders > 0)
+        if start is not None:
+            query = query.filter(cls.date_created >= start)
+        if end is not None:
+            query = query.filter(cls.date_created <= end)
+        if after_date is not None:
+            query = query.filter(cls.date_created > after_date)
+        return query.order_by(cls.date_created).limit(limit).all()
+
+    @classmethod
+    def rebuild(cls, start=None, end=None, batch_days=31):
+        """Recomputes the daily rollups from the Orders and Items
+
+        The days are rebuilt batch_days at a time, one transaction per batch,
+        so a backfill over years of history never holds its locks for long.
+        On PostgreSQL the rollup tables are locked against concurrent writes
+        while a batch is rebuilt; the writes wait and then add their changes.
+
+        :param start: the first day to rebuild, the first Order by default
+        :type start: date
+
+        :param end: the last day to rebuild, the last Order by default
+        :type end: date
+
+        :param batch_days: the number of days rebuilt per transaction
+        :type batch_days: int
+
+        :return: the number of days with Orders rebuilt
+        :rtype: int
+
+        """
+        first, last = db.session.query(
+            db.func.min(Order.date_created), db.func.max(Order.date_created)
+        ).one()
+        db.session.commit()
+        start = start or first
+        end = end or last
+        if start is None or end is None:
+            return 0
+        rebuilt = 0
+        window = start
+        while window <= end:
+            window_end = min(window + timedelta(days=batch_days - 1), end)
+            logger.info("Rebuilding daily rollups from %s to %s", window, window_end)
+            rebuilt += _rebuild_rollups(db.session.connection(), window, window_end)
+            db.session.commit()
+            window = window_end + timedelta(days=1)
+        return rebuilt
+
+
+class DailyProduct(db.Model):
+    """
+    Number of Items of every product in the Orders of every day
+
+    Holds one row per product ordered on a day, so DailyRollup can report the
+    number of distinct products of a day without scanning its Items.
+    """
+
+    __tablename__ = "daily_product"
+
+    date_created = db.Column(db.Date(), primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    items = db.Column(db.Integer, nullable=False, default=0)
+
+
+class OrderEvent(db.Model):
+    """
+    The outbox of changes to the Orders and Items
+
+    Every write appends one event per Order or Item it creates, updates or
+    deletes, in the transaction of the write (see _append_events), so an event
+    exists exactly when its change was committed. The events are read in id
+    order by GET /api/orders_events and by the relay (flask relay-events).
+    Deleting an Order deletes its Items without an event for each of them.
+
+    On PostgreSQL the writes append to PendingEvent instead, and the readers
+    move the committed events here (see sequence).
+    """
+
+    __tablename__ = "order_event"
+    # ids are never reused, even after the newest events are pruned
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    entity = db.Column(db.String(8), nullable=False)  # order or item
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(8), nullable=False)  # created, updated or deleted
+    # the row after the change, None when it was deleted
+    data = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+
+    def serialize(self):
+        """ Serializes an OrderEvent into a dictionary """
+        return {
+            "id": self.id, "order_id": self.order_id, "entity": self.entity,
+            "entity_id": self.entity_id, "action": self.action, "data": self.data,
+            "created_at": self.created_at.isoformat(),
+        }
+
+    @classmethod
+    def after(cls, after_id=None, limit=None):
+        """Returns the events after an event, oldest first
+
+        :param after_id: the id of the last event seen, from the first event when None
+        :type after_id: int
+
+        :param limit: the maximum number of events to return
+        :type limit: int
+
+        :return: a page of serialized events
+        :rtype: list
+        """
+        cls.sequence()
+        return cls._page(after_id, limit)
+
+    @classmethod
+    def _page(cls, after_id, limit):
+        """Returns the events after an event without moving the pending ones"""
+        query = cls.query
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        return [event.serialize() for event in query.order_by(cls.id).limit(limit)]
+
+    @classmethod
+    def sequence(cls):
+        """Moves the events of the committed transactions from PendingEvent, on PostgreSQL
+
+        Pending ids are handed out before the transactions commit, so a reader
+        of them could move past an id still to be committed. Here they are
+        numbered only once committed, in pending id order, which keeps the
+        events of an Order in the order of its changes: a write to an Order
+        waits for the one before it to commit. The readers take turns through
+        an advisory lock, one finding it taken reads what was already moved.
+        Commits the session.
+        """
+        connection = db.session.connection()
+        if connection.dialect.name == "postgresql":
+            locked = connection.execute(db.text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": EVENT_LOCK_KEY})
+            if locked.scalar():
+                connection.execute(db.text(MOVE_PENDING_EVENTS))
+        db.session.commit()
+
+    @classmethod
+    def last_id(cls):
+        """Returns the id of the newest event, 0 when there is none"""
+        cls.sequence()
+        return db.session.query(db.func.max(cls.id)).scalar() or 0
+
+    @classmethod
+    def pruned_after(cls, event_id):
+        """Checks whether events after an id were pruned, so they can not be read anymore"""
+        oldest = db.session.query(db.func.min(cls.id)).scalar()
+        return oldest is not None and oldest > event_id + 1
+
+    @classmethod
+    def relay(cls, name, publish, batch_size=500):
+        """Hands the events after the cursor of a relay to publish, a batch at a time
+
+        The cursor is locked while a batch is published and moved past it in
+        the same transaction, so relays of the same name take turns and every
+        event is published at least once, in id order. An error from publish
+        leaves the cursor where it was.
+
+        :param name: the name of the relay, every relay has its own cursor
+        :type name: str
+
+        :param publish: called with every batch of serialized events
+        :type publish: function
+
+        :param batch_size: the number of events per batch
+        :type batch_size: int
+
+        :return: the number of events published
+        :rtype: int
+        """
+        total = 0
+        while True:
+            try:
+                cls.sequence()
+                cursor = EventCursor.query.with_for_update().get(name)
+                if cursor is None:
+                    cursor = EventCursor(name=name, last_id=0)
+                    db.session.add(cursor)
+                events = cls._page(cursor.last_id, batch_size)
+                if events:
+                    publish(events)
+                    cursor.last_id = events[-1]["id"]
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            total += len(events)
+            if len(events) < batch_size:
+                return total
+
+    @classmethod
+    def prune(cls, before):
+        """Deletes the events created before a time that every relay published
+
+        The newest event is always kept, see pruned_after.
+
+        :param before: the time of the oldest event to keep
+        :type before: datetime
+
+        :return: the number of events deleted
+        :rtype: int
+        """
+        query = cls.query.filter(cls.created_at < before, cls.id < cls.last_id())
+        published = db.session.query(db.func.min(EventCursor.last_id)).scalar()
+        if published is not None:
+            query = query.filter(cls.id <= published)
+        deleted = query.delete(synchronize_session=False)
+        db.session.commit()
+        logger.info("Pruned %d order events", deleted)
+        return deleted
+
+
+class PendingEvent(db.Model):
+    """
+    The events of the transactions that may not be committed yet, on PostgreSQL
+
+    OrderEvent.sequence moves them to the outbox once committed.
+    """
+
+    __tablename__ = "order_event_pending"
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    entity = db.Column(db.String(8), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(8), nullable=False)
+    data = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+
+
+class EventCursor(db.Model):
+    """
+    The id of the last OrderEvent a relay published
+    """
+
+    __tablename__ = "event_cursor"
+
+    name = db.Column(db.String(64), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(db.Model):
+    """
+    The response to a request sent with an Idempotency-Key header
+
+    The key is the primary key, so two requests with the same key can not both
+    store one: the second waits for the first to commit and then fails, and
+    the Order it created is rolled back with it (see create_order).
+    """
+
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        db.Index("ix_idempotency_key_created_at", "created_at"),
+    )
+
+    key = db.Column(db.String(255), primary_key=True)
+    # the SHA-256 of the request body, to tell a retry from another request
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def find(cls, key):
+        """Finds the stored response of a key, None when there is none"""
+        logger.info("Looking up idempotency key %s", key)
+        return cls.query.get(key)
+
+    @classmethod
+    def create_order(cls, key, request_hash, order):
+        """Creates an Order and stores the response with the key, in one transaction
+
+        When another request stored the key first the Order is not created.
+
+        :param key: the Idempotency-Key of the request
+        :type key: str
+
+        :param request_hash: the SHA-256 of the request body
+        :type request_hash: str
+
+        :param order: the new Order
+        :type order: Order
+
+        :return: the IdempotencyKey stored by the request that created the Order
+        :rtype: IdempotencyKey
+        """
+        logger.info("Creating %s with idempotency key %s", order.name, key)
+        order.id = None
+        db.session.add(order)
+        try:
+            db.session.flush()
+            stored = cls(key=key, request_hash=request_hash, status_code=201, response=order.serialize())
+            db.session.add(stored)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            stored = cls.find(key)
+            if stored is None:
+                raise
+            logger.info("Idempotency key %s was stored by another request", key)
+        return stored
+
+    @classmethod
+    def expire(cls, before, batch_size=1000):
+        """Deletes the keys stored before a time, batch_size at a time
+
+        Every batch is deleted in its own short transaction, oldest first.
+
+        :param before: the time of the oldest key to keep
+        :type before: datetime
+
+        :param batch_size: the number of keys deleted per transaction
+        :type batch_size: int
+
+        :return: the number of keys deleted
+        :rtype: int
+        """
+        total = 0
+        while True:
+            query = db.session.query(cls.key).filter(cls.created_at < before).\
+                order_by(cls.created_at).limit(batch_size)
+            keys = [row.key for row in query]
+            if keys:
+                cls.query.filter(cls.key.in_(keys)).delete(synchronize_session=False)
+            db.session.commit()
+            total += len(keys)
+            if len(keys) < batch_size:
+                logger.info("Expired %d idempotency keys", total)
+                return total
+
+
+######################################################################
+#  B U L K   H E L P E R S
+######################################################################
+def _allocate_ids(model, count):
+    """Reserves count primary keys for new rows of a model in one round-trip"""
+    if count == 0:
+        return []
+    table = model.__table__
+    if db.engine.dialect.name == "postgresql":
+        preparer = db.engine.dialect.identifier_preparer
+        result = db.session.execute(
+            db.text(
+                "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                "FROM generate_series(1, :count)"
+            ),
+            {"table": preparer.format_table(table), "count": count},
+        )
+        return [row[0] for row in result]
+    # Databases without sequences (SQLite in the tests) continue after the
+    # highest id, relying on the database serializing writers
+    highest = db.session.execute(db.select(db.func.max(table.c.id))).scalar() or 0
+    return list(range(highest + 1, highest + 1 + count))
+
+
+def _insert_rows(table, rows):
+    """Writes rows into a table with as few multi-row INSERTs as possible"""
+    for start in range(0, len(rows), ROWS_PER_INSERT):
+        db.session.execute(table.insert().values(rows[start:start + ROWS_PER_INSERT]))
+
+
+######################################################################
+#  S U M M A R Y   T A B L E S
+######################################################################
+# the Item columns the summary tables are computed from
+SUMMARY_COLUMNS = ("product_id", "quantity", "price")
+
+
+def _write_item_changes(connection, updates, deletes, updated_at):
+    """Updates and deletes Items with one statement per IDS_PER_SELECT Items
+
+    :param updates: the new values by Item id, see Order.change_items
+    :param deletes: the ids of the Items to delete, as a list
+    :param updated_at: the time the Items are updated
+    """
+    table = Item.__table__
+    updated = sorted(updates)
+    for start in range(0, len(updated), IDS_PER_SELECT):
+        chunk = updated[start:start + IDS_PER_SELECT]
+        values = {}
+        for column in ITEM_CHANGE_COLUMNS:
+            whens = {item_id: updates[item_id][column] for item_id in chunk if column in updates[item_id]}
+            if whens:
+                values[column] = db.case(whens, value=table.c.id, else_=table.c[column])
+        connection.execute(table.update().where(table.c.id.in_(chunk)).values(updated_at=updated_at, **values))
+    for start in range(0, len(deletes), IDS_PER_SELECT):
+        connection.execute(table.delete().where(table.c.id.in_(deletes[start:start + IDS_PER_SELECT])))
+
+
+def _whole_quantity(quantity):
+    """Converts a quantity to an int, the integer column would round 3.7 to 4"""
+    value = float(quantity)
+    if not value.is_integer():
+        raise ValueError(f"quantity must be a whole number, not {quantity!r}")
+    return int(value)
+
+
+def _product_deltas(changes):
+    """Adds up (product_id, quantity, price, sign) changes by product"""
+    deltas = {}
+    for product_id, quantity, price, sign in changes:
+        if product_id is None:
+            continue  # the row is rejected by the database
+        # the columns may have been assigned strings the database converts
+        try:
+            quantity = _whole_quantity(quantity) if quantity is not None else 1
+            price = float(price) if price is not None else 0.0
+            product_id = int(product_id)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError("Invalid Item: " + str(error)) from error
+        item_count, total_quantity, revenue = deltas.get(product_id, (0, 0, 0.0))
+        deltas[product_id] = (
+            item_count + sign,
+            total_quantity + sign * quantity,
+            revenue + sign * quantity * price,
+        )
+    return {key: value for key, value in deltas.items() if value != (0, 0, 0.0)}
+
+
+def _stored_items(session, items):
+    """Returns the (product_id, quantity, price, order_id) stored for Items by id
+
+    The rows are read with FOR UPDATE, so a concurrent transaction changing
+    the same Items waits and then reads the values this one writes.
+    """
+    ids = [item.id for item in items if item.id is not None]
+    if not ids:
+        return {}
+    rows = session.execute(
+        db.select(Item.id, Item.product_id, Item.quantity, Item.price, Item.order_id).
+        where(Item.id.in_(ids)).with_for_update()
+    )
+    return {row.id: (row.product_id, row.quantity, row.price, row.order_id) for row in rows}
+
+
+def _item_changes(session, stored):
+    """Yields the (product_id, quantity, price, sign) changes a flush makes
+
+    Changed and deleted Items are compared with the values stored in the
+    database, the objects may have been expired before they were changed.
+    """
+    for obj in session.new:
+        if isinstance(obj, Item):
+            yield obj.product_id, obj.quantity, obj.price, 1
+    for obj in _changed(session, Item, SUMMARY_COLUMNS):
+        if obj.id in stored:
+            yield stored[obj.id][:3] + (-1,)
+        yield obj.product_id, obj.quantity, obj.price, 1
+    for obj in session.deleted:
+        if isinstance(obj, Item) and obj.id in stored:
+            yield stored[obj.id][:3] + (-1,)
+
+
+def _changed(session, model, columns):
+    """Returns the objects of a model the flush updates in one of the columns"""
+    return [
+        obj for obj in session.dirty
+        if isinstance(obj, model) and obj not in session.deleted and any(
+            db.inspect(obj).attrs[name].history.has_changes() for name in columns
+        )
+    ]
+
+
+def _order_id_of(item):
+    """Returns the id of the Order an Item belongs to, if it has one yet"""
+    if item.order_id is not None:
+        return item.order_id
+    return item.order.id if item.order is not None else None
+
+
+def _touched_orders(session, stored):
+    """Returns the ids of the stored Orders whose rollups a flush may change"""
+    order_ids = set()
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            order_ids.add(obj.id)
+    for obj in _changed(session, Order, ("date_created",)):
+        order_ids.add(obj.id)
+    for obj in list(session.new) + _changed(session, Item, SUMMARY_COLUMNS + ("order_id",)):
+        if isinstance(obj, Item):
+            order_ids.add(_order_id_of(obj))
+    for values in stored.values():
+        order_ids.add(values[3])
+    order_ids.discard(None)
+    return order_ids
+
+
+def _order_contributions(session, order_ids, lock=False):
+    """Returns what the stored Orders add to the daily rollups
+
+    :return: {date: [orders, items, quantity, revenue]} and
+             {(date, product_id): items}
+    :rtype: tuple
+    """
+    days, products = {}, {}
+    if not order_ids:
+        return days, products
+    query = db.select(
+        Order.id, Order.date_created, Item.product_id, Item.quantity, Item.price
+    ).outerjoin(Item, Item.order_id == Order.id).where(Order.id.in_(sorted(order_ids)))
+    if lock:
+        # serializes the flushes of concurrent transactions on the same Orders
+        query = query.with_for_update(of=Order)
+    seen = set()
+    for order_id, day, product_id, quantity, price in session.execute(query):
+        totals = days.setdefault(day, [0, 0, 0, 0.0])
+        if order_id not in seen:
+            seen.add(order_id)
+            totals[0] += 1
+        if product_id is None:
+            continue  # an Order without Items
+        totals[1] += 1
+        totals[2] += quantity
+        totals[3] += price * quantity
+        products[(day, product_id)] = products.get((day, product_id), 0) + 1
+    return days, products
+
+
+def _rollup_deltas(after, before):
+    """Subtracts two _order_contributions"""
+    days = {day: list(totals) for day, totals in after[0].items()}
+    for day, totals in before[0].items():
+        current = days.setdefault(day, [0, 0, 0, 0.0])
+        for index, value in enumerate(totals):
+            current[index] -= value
+    products = dict(after[1])
+    for key, items in before[1].items():
+        products[key] = products.get(key, 0) - items
+    return (
+        {day: totals for day, totals in days.items() if any(totals)},
+        {key: items for key, items in products.items() if items},
+    )
+
+
+def _upsert_add(connection, table, keys, rows):
+    """Adds the values of rows to the stored rows with the same keys
+
+    Every row is written with INSERT ... ON CONFLICT DO UPDATE adding to the
+    stored values, so concurrent writers never overwrite each other's totals.
+    The rows are sorted by key so concurrent writers lock them in one order.
+    """
+    if not rows:
+        return
+    dialect = postgresql if connection.dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c[key] for key in keys],
+        set_={
+            name: table.c[name] + statement.excluded[name]
+            for name in rows[0] if name not in keys
+        },
+    )
+    connection.execute(statement, sorted(rows, key=lambda row: tuple(row[key] for key in keys)))
+
+
+def _add_to_rollups(connection, deltas):
+    """Adds _order_contributions or _rollup_deltas to the daily rollups"""
+    days, products = deltas
+    _upsert_add(connection, DailyRollup.__table__, ["date_created"], [
+        {"date_created": day, "orders": orders, "items": items, "quantity": quantity, "revenue": revenue}
+        for day, (orders, items, quantity, revenue) in days.items()
+    ])
+    _upsert_add(connection, DailyProduct.__table__, ["date_created", "product_id"], [
+        {"date_created": day, "product_id": product_id, "items": items}
+        for (day, product_id), items in products.items()
+    ])
+    if any(items < 0 for items in products.values()):
+        # a product no longer ordered on a day is not one of its distinct products
+        table = DailyProduct.__table__
+        connection.execute(table.delete().where(
+            table.c.date_created.in_({day for day, _ in products}), table.c["items"] <= 0
+        ))
+
+
+def _rebuild_rollups(connection, start, end):
+    """Recomputes the rollups of the days from start to end in one transaction"""
+    rollup, daily_product = DailyRollup.__table__, DailyProduct.__table__
+    if connection.dialect.name == "postgresql":
+        connection.execute(db.text(
+            "LOCK TABLE daily_rollup, daily_product IN SHARE ROW EXCLUSIVE MODE"
+        ))
+    for table in (rollup, daily_product):
+        connection.execute(table.delete().where(table.c.date_created.between(start, end)))
+    order, item = Order.__table__, Item.__table__
+    in_window = order.c.date_created.between(start, end)
+    result = connection.execute(rollup.insert().from_select(
+        ["date_created", "orders", "items", "quantity", "revenue"],
+        db.select(
+            order.c.date_created, db.func.count(db.distinct(order.c.id)), db.func.count(item.c.id),
+            db.func.coalesce(db.func.sum(item.c.quantity), 0),
+            db.func.coalesce(db.func.sum(item.c.price * item.c.quantity), 0.0),
+        ).select_from(order.outerjoin(item, item.c.order_id == order.c.id)).
+        where(in_window).group_by(order.c.date_created),
+    ))
+    connection.execute(daily_product.insert().from_select(
+        ["date_created", "product_id", "items"],
+        db.select(order.c.date_created, item.c.product_id, db.func.count(item.c.id)).
+        select_from(order.join(item, item.c.order_id == order.c.id)).
+        where(in_window).group_by(order.c.date_created, item.c.product_id),
+    ))
+    return result.rowcount
+
+
+def _add_to_product_summary(connection, deltas):
+    """Adds item count, quantity and revenue deltas to the product summary"""
+    _upsert_add(connection, ProductSummary.__table__, ["product_id"], [
+        {"product_id": key, "item_count": count, "quantity": quantity, "revenue": revenue}
+        for key, (count, quantity, revenue) in deltas.items()
+    ])
+
+
+@db.event.listens_for(db.session, "before_flush")
+def _collect_summary_deltas(session, flush_context, instances):  # pylint: disable=unused-argument
+    """Works out how the flush changes the summary tables, before it runs
+
+    The versions of the changed Orders are bumped here too, from the same
+    stored Items.
+    """
+    with session.no_autoflush:
+        deleted = [obj for obj in session.deleted if isinstance(obj, Item)]
+        changed = _changed(session, Item, SUMMARY_COLUMNS + ("order_id",))
+        stored = _stored_items(session, deleted + changed)
+        session.info["product_deltas"] = _product_deltas(_item_changes(session, stored))
+        order_ids = _touched_orders(session, stored)
+        session.info["rollups_before"] = (
+            order_ids, _order_contributions(session, order_ids, lock=True)
+        )
+        _bump_versions(session, stored)
+
+
+@db.event.listens_for(db.session, "after_flush")
+def _apply_summary_deltas(session, flush_context):  # pylint: disable=unused-argument
+    """Applies the changes to the summary tables in the flush's transaction"""
+    connection = session.connection()
+    _add_to_product_summary(connection, session.info.pop("product_deltas", {}))
+    order_ids, before = session.info.pop("rollups_before", (set(), ({}, {})))
+    order_ids = order_ids | {obj.id for obj in session.new if isinstance(obj, Order)}
+    after = _order_contributions(session, order_ids)
+    _add_to_rollups(connection, _rollup_deltas(after, before))
+
+
+######################################################################
+#  C H A N G E   E V E N T S
+######################################################################
+# Taken by the reader moving the pending events on PostgreSQL, see OrderEvent.sequence
+EVENT_LOCK_KEY = 0x0bde7e47
+
+# Moves the committed pending events to the outbox, numbered in pending id order
+MOVE_PENDING_EVENTS = """
+WITH moved AS (DELETE FROM order_event_pending RETURNING *)
+INSERT INTO order_event (order_id, entity, entity_id, action, data, created_at)
+SELECT order_id, entity, entity_id, action, data, created_at FROM moved ORDER BY id
+"""
+
+
+def _json_row(row):
+    """Returns a row as a dictionary of JSON values"""
+    return {
+        key: value.isoformat() if isinstance(value, date) else value
+        for key, value in row.items()
+    }
+
+
+def _read_rows(connection, model, ids):
+    """Returns the rows of a model with the given ids as JSON dictionaries by id"""
+    table = model.__table__
+    ids = sorted(ids)
+    rows = {}
+    for start in range(0, len(ids), IDS_PER_SELECT):
+        for row in connection.execute(table.select().where(table.c.id.in_(ids[start:start + IDS_PER_SELECT]))):
+            rows[row.id] = _json_row(row._mapping)  # pylint: disable=protected-access
+    return rows
+
+
+def _append_events(connection, events):
+    """Writes change events to the outbox in the transaction of the changes
+
+    An event is (entity, entity_id, order_id, action, data). When data is
+    None for a create or an update the row is read back from the database.
+
+    On PostgreSQL the ids of concurrent transactions would be committed out
+    of order, and a reader could move past an id still to be committed. The
+    events go to PendingEvent there, without any lock shared by the writers,
+    and OrderEvent.sequence numbers them once committed.
+    """
+    if not events:
+        return
+    models = {"order": Order, "item": Item}
+    missing = {entity: set() for entity in models}
+    for entity, entity_id, _, action, data in events:
+        if data is None and action != "deleted":
+            missing[entity].add(entity_id)
+    rows = {entity: _read_rows(connection, models[entity], ids) for entity, ids in missing.items() if ids}
+    now = datetime.utcnow()
+    values = []
+    for entity, entity_id, order_id, action, data in events:
+        if data is None and action != "deleted":
+            data = rows[entity].get(entity_id)
+        values.append({
+            "order_id": order_id, "entity": entity, "entity_id": entity_id,
+            "action": action, "data": data, "created_at": now,
+        })
+    table = (PendingEvent if connection.dialect.name == "postgresql" else OrderEvent).__table__
+    for start in range(0, len(values), ROWS_PER_INSERT):
+        connection.execute(table.insert().values(values[start:start + ROWS_PER_INSERT]))
+
+
+def _flush_event(obj, action):
+    """Returns the event of an Order or Item a flush writes, None for other objects
+
+    Items are taken from the objects. Orders are read back, since their
+    version and defaults are set by the database.
+    """
+    if isinstance(obj, Order):
+        return ("order", obj.id, obj.id, action, None)
+    if isinstance(obj, Item):
+        return ("item", obj.id, obj.order_id, action, obj.serialize() if action != "deleted" else None)
+    return None
+
+
+def _flush_events(session):
+    """Returns the events of the Orders and Items a flush writes"""
+    changed = [
+        obj for obj in session.dirty
+        if obj not in session.deleted and session.is_modified(obj, include_collections=False)
+    ]
+    events = (
+        [_flush_event(obj, "created") for obj in session.new] +
+        [_flush_event(obj, "updated") for obj in changed] +
+        [_flush_event(obj, "deleted") for obj in session.deleted]
+    )
+    # the Orders first, their Items may refer to them
+    return sorted((event for event in events if event is not None), key=lambda event: event[0] == "item")
+
+
+@db.event.listens_for(db.session, "after_flush")
+def _write_flush_events(session, flush_context):  # pylint: disable=unused-argument
+    """Appends the events of the Orders and Items a flush wrote to the outbox"""
+    _append_events(session.connection(), _flush_events(session))
+
+
+######################################################################
+#  O R D E R   V E R S I O N S
+######################################################################
+def _versioned_orders(session, stored):
+    """Returns the stored Orders a flush changes, and those whose Items it changes"""
+    orders, item_orders = [], set()
+    for obj in session.dirty:
+        if obj in session.deleted or not session.is_modified(obj, include_collections=False):
+            continue
+        if isinstance(obj, Order):
+            orders.append(obj)
+        elif isinstance(obj, Item):
+            item_orders.add(_order_id_of(obj))
+    # the Orders that changed or moved Items belonged to
+    item_orders.update(values[3] for values in stored.values())
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Item):
+            item_orders.add(_order_id_of(obj))
+    item_orders -= {obj.id for obj in orders}
+    item_orders -= {obj.id for obj in session.deleted if isinstance(obj, Order)}
+    item_orders.discard(None)
+    return orders, item_orders
+
+
+def _bump_versions(session, stored):
+    """Increments the version of every Order the flush changes
+
+    A changed Order gets version = version + 1 in its own UPDATE. The Orders
+    whose Items change are bumped with one UPDATE statement, and their loaded
+    copies forget the old version. Called before the flush, with the rows
+    _stored_items read for the changed and deleted Items.
+    """
+    orders, item_orders = _versioned_orders(session, stored)
+    for order in orders:
+        order.version = Order.version + 1
+    if not item_orders:
+        return
+    table = Order.__table__
+    session.connection().execute(
+        table.update().where(table.c.id.in_(sorted(item_orders))).values(version=table.c.version + 1)
+    )
+    for order_id in item_orders:
+        order = session.identity_map.get(db.inspect(Order).identity_key_from_primary_key([order_id]))
+        if order is not None:
+            session.expire(order, ["version"])
@@ -9,15 +9,33 @@ its customer id. A good action for the order API is to be able to cancel an orde
 
 """
 
-from flask import abort, request, render_template, make_response, jsonify
-from service.models import Item, Order
+from flask import abort, request, render_template, make_response, jsonify, json
+from flask import Response, stream_with_context
+from werkzeug.http import quote_etag
+from service.models import Item, Order, ProductSummary, DailyRollup, DataValidationError, ORDER_SORTS
+from service.models import ORDER_TRANSITIONS, IdempotencyKey, OrderEvent
 from service.models import db
+from sqlalchemy.exc import SQLAlchemyError
 from flask_restx import Resource, fields
-from datetime import date
+from datetime import date, datetime
+import hashlib
+import math
+import time
 
 # Import Flask application
 from . import app, api
 from .common import status  # HTTP Status Codes
+from .common.pagination import encode_token, decode_token, InvalidTokenError
+from .common.pool_stats import pool_stats
+from .common.cache import order_cache
+from .common.serialization import compile_list, compile_model, dumps
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+EVENT_STREAM_MIMETYPE = "text/event-stream"
+# The actions on an Order -> the status they move it to
+ORDER_ACTIONS = {"cancel": "cancelled", "ship": "shipped", "deliver": "delivered"}
+# the length of the key column of IdempotencyKey
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
 
 create_item_model = api.model('Item', {
     'product_id': fields.Integer(required=True, description='The ID of the product'),
@@ -30,7 +48,10 @@ create_item_model = api.model('Item', {
 item_model = api.inherit(
     'ItemModel',
     create_item_model,
-    {'id': fields.Integer(readOnly=True, description='The unique id assigned internally by service'), }
+    {
+        'id': fields.Integer(readOnly=True, description='The unique id assigned internally by service'),
+        'updated_at': fields.String(readOnly=True, description='When the Item last changed, in UTC'),
+    }
 )
 
 # Define the model so that the docs reflect what can be sent
@@ -42,6 +63,8 @@ create_model = api.model('Order', {
         default="9609 Helen Rd. Wisconsin Rapids, WI 54494"
         ),
     'date_created': fields.Date(description='The date order created', default="2022-12-14"),
+    'status': fields.String(readOnly=True, description='open, shipped, delivered or cancelled, see the actions'),
+    'updated_at': fields.String(readOnly=True, description='When the Order or one of its Items last changed, in UTC'),
     'items': fields.List(fields.Nested(item_model, description='List of items that order contains'))
 })
 
@@ -51,11 +74,179 @@ order_model = api.inherit(
     {'id': fields.Integer(readOnly=True, description='The unique id assigned internally by service'), }
 )
 
+search_result_model = api.inherit(
+    'SearchResult',
+    order_model,
+    {'rank': fields.Float(readOnly=True, description='How well the Order matches, higher is better'), }
+)
+
+# The list endpoints marshal with precompiled models, giving what marshal()
+# gives for the serialized dicts in a fraction of the time
+marshal_order = compile_model(order_model)
+marshal_orders = compile_list(order_model)
+marshal_item = compile_model(item_model)
+marshal_items = compile_list(item_model)
+marshal_search_results = compile_list(search_result_model)
+
 price_model = api.model('Price', {
     'min_price': fields.Float(required=True, description='The maximal price in the query', default="0.0"),
-    'max_price': fields.Float(required=True, description='The minimal price in the query', default="100.0")
+    'max_price': fields.Float(required=True, description='The minimal price in the query', default="100.0"),
+    'limit': fields.Integer(description='The maximum number of results to return in one page'),
+    'after': fields.String(description='The page token returned in X-Next-Page-Token by the previous page')
 })
 
+bulk_result_model = api.model('BulkResult', {
+    'index': fields.Integer(description='The position of the Order in the request'),
+    'status': fields.Integer(description='201 if the Order was created, or the error status'),
+    'id': fields.Integer(description='The id assigned to the created Order'),
+    'item_ids': fields.List(fields.Integer, description='The ids assigned to the Items of the Order'),
+    'error': fields.String(description='Why the Order was not created')
+})
+
+item_change_model = api.model('ItemChange', {
+    'id': fields.Integer(required=True, description='The id of the Item to change'),
+    'status': fields.String(description='The new status of the Item'),
+    'quantity': fields.Integer(description='The new quantity of the Item'),
+    'price': fields.Float(description='The new price of the Item'),
+    'delete': fields.Boolean(description='true to delete the Item instead')
+})
+
+item_change_result_model = api.model('ItemChangeResult', {
+    'index': fields.Integer(description='The position of the change in the request'),
+    'id': fields.Integer(description='The id of the Item'),
+    'status': fields.Integer(description='200 if the Item was changed, 204 if deleted, or the error status'),
+    'error': fields.String(description='Why the change was not made')
+})
+
+delete_result_model = api.model('DeleteResult', {
+    'deleted': fields.Integer(description='The number of Orders deleted'),
+    'more': fields.Boolean(description='Whether Orders of the days are left, send the request again to delete them')
+})
+
+event_model = api.model('OrderEvent', {
+    'id': fields.Integer(description='The position of the event, send it back as after to resume'),
+    'order_id': fields.Integer(description='The Order that changed, or whose Item changed'),
+    'entity': fields.String(description='order or item'),
+    'entity_id': fields.Integer(description='The id of the Order or Item'),
+    'action': fields.String(description='created, updated or deleted'),
+    'data': fields.Raw(description='The Order or Item after the change, null when it was deleted'),
+    'created_at': fields.String(description='When the change was made, in UTC')
+})
+marshal_events = compile_list(event_model)
+
+sync_model = api.model('OrderSync', {
+    'orders': fields.List(fields.Nested(order_model), description='The Orders changed since the token'),
+    'deleted': fields.List(fields.Integer, description='The ids of the Orders deleted since the token'),
+    'token': fields.String(description='The token to send on the next sync'),
+    'more': fields.Boolean(description='true when there are more changes, sync again with the token right away')
+})
+marshal_sync = compile_model(sync_model)
+
+# query string arguments selecting the Orders to delete at once
+delete_args = api.parser()
+delete_args.add_argument('id', type=int, location='args', action='append', required=False,
+                         help='The id of an Order to delete, may be repeated')
+delete_args.add_argument('start', type=str, location='args', required=False,
+                         help='Delete the Orders created on or after this day, in ISO format')
+delete_args.add_argument('end', type=str, location='args', required=False,
+                         help='Delete the Orders created on or before this day, in ISO format')
+
+bulk_args = api.parser()
+bulk_args.add_argument('chunk_size', type=int, location='args', required=False,
+                       help='The number of Orders written per transaction')
+
+total_model = api.model('OrderTotal', {
+    'order_id': fields.Integer(description='The id of the Order'),
+    'item_count': fields.Integer(description='The number of Items in the Order'),
+    'quantity': fields.Integer(description='The number of products in the Order'),
+    'total': fields.Float(description='The sum of price * quantity over the Items'),
+})
+
+revenue_model = api.model('DailyRevenue', {
+    'date': fields.Date(description='The day the Orders were created'),
+    'orders': fields.Integer(description='The number of Orders created that day'),
+    'items': fields.Integer(description='The number of Items of those Orders'),
+    'quantity': fields.Integer(description='The number of products of those Orders'),
+    'revenue': fields.Float(description='The sum of price * quantity over those Items'),
+    'distinct_products': fields.Integer(description='The number of different products ordered that day'),
+})
+
+product_model = api.model('ProductSummary', {
+    'product_id': fields.Integer(description='The ID of the product'),
+    'item_count': fields.Integer(description='The number of Items of the product'),
+    'quantity': fields.Integer(description='The number of units ordered'),
+    'revenue': fields.Float(description='The sum of price * quantity over the Items'),
+})
+
+# query string arguments for paging through a report
+report_args = api.parser()
+report_args.add_argument('limit', type=int, location='args', required=False,
+                         help='The maximum number of rows to return in one page, MAX_PAGE_SIZE by default')
+report_args.add_argument('after', type=str, location='args', required=False,
+                         help='The page token returned in X-Next-Page-Token by the previous page')
+
+revenue_args = report_args.copy()
+revenue_args.add_argument('start', type=str, location='args', required=False,
+                          help='The first day to report in ISO format')
+revenue_args.add_argument('end', type=str, location='args', required=False,
+                          help='The last day to report in ISO format')
+
+# query string arguments for paging through a collection
+SORT_CHOICES = tuple(f"{prefix}{key}" for key in ORDER_SORTS for prefix in ("", "-"))
+page_args = api.parser()
+page_args.add_argument('limit', type=int, location='args', required=False,
+                       help='The maximum number of Orders to return in one page')
+page_args.add_argument('after', type=str, location='args', required=False,
+                       help='The page token returned in X-Next-Page-Token by the previous page')
+
+# query string arguments filtering and sorting the Orders, all filters combine
+search_args = page_args.copy()
+search_args.add_argument('name', type=str, location='args', required=False,
+                         help='Only the Orders with this name')
+search_args.add_argument('start', type=str, location='args', required=False,
+                         help='Only the Orders created on or after this day, in ISO format')
+search_args.add_argument('end', type=str, location='args', required=False,
+                         help='Only the Orders created on or before this day, in ISO format')
+search_args.add_argument('product_id', type=int, location='args', required=False,
+                         help='Only the Orders with an Item of this product')
+search_args.add_argument('min_price', type=float, location='args', required=False,
+                         help='Only the Orders with an Item of at least this price')
+search_args.add_argument('max_price', type=float, location='args', required=False,
+                         help='Only the Orders with an Item of at most this price')
+search_args.add_argument('status', type=str, location='args', required=False,
+                         help='Only the Orders with an Item in this status')
+search_args.add_argument('order_status', type=str, location='args', required=False,
+                         choices=tuple(ORDER_TRANSITIONS),
+                         help='Only the Orders in this status')
+search_args.add_argument('status_since', type=str, location='args', required=False,
+                         help='Only the Orders that got their status on or after this day, in ISO format')
+search_args.add_argument('updated_since', type=str, location='args', required=False,
+                         help='Only the Orders changed after this time, an ISO date and time in UTC')
+search_args.add_argument('sort', type=str, location='args', required=False, default='id',
+                         choices=SORT_CHOICES,
+                         help='The sort key, with a leading - for descending order')
+
+# query string arguments of an incremental sync
+sync_args = api.parser()
+sync_args.add_argument('token', type=str, location='args', required=False,
+                       help='The token returned by the last sync, leave out on the first one')
+sync_args.add_argument('limit', type=int, location='args', required=False,
+                       help='The maximum number of changes to read at once')
+
+# query string arguments reading the change events
+event_args = api.parser()
+event_args.add_argument('after', type=int, location='args', required=False,
+                        help='The id of the last event received, Last-Event-ID when streaming')
+event_args.add_argument('limit', type=int, location='args', required=False,
+                        help='The maximum number of events to return at once')
+event_args.add_argument('wait', type=float, location='args', required=False, default=0.0,
+                        help='Seconds to wait for an event when there is none yet')
+
+# query string arguments of a text search over the names and addresses
+text_search_args = page_args.copy()
+text_search_args.add_argument('q', type=str, location='args', required=True,
+                              help='The words to look for, each one starts a word of the name or address')
+
 
 ######################################################################
 # GET INDEX
@@ -76,6 +267,24 @@ def healthcheck():
     return make_response(jsonify(status=200, message="OK"), status.HTTP_200_OK)
 
 
+######################################################################
+# GET CONNECTION POOL STATISTICS
+######################################################################
+@app.route("/pool")
+def pool():
+    """Reports the connection pool usage of this worker process"""
+    return make_response(jsonify(pool_stats.snapshot(db.engine.pool)), status.HTTP_200_OK)
+
+
+######################################################################
+# GET ORDER CACHE STATISTICS
+######################################################################
+@app.route("/cache")
+def cache():
+    """Reports the hits and misses of the order cache of this worker process"""
+    return make_response(jsonify(order_cache.stats()), status.HTTP_200_OK)
+
+
 @app.route("/reset")
 def reset():
     """Reset the database"""
@@ -84,6 +293,7 @@ def reset():
     db.drop_all()
     db.create_all()
     db.session.commit()
+    order_cache.clear()
     app.logger.info("Reset succeed!")
     return make_response(jsonify(status=200, message="Reset"), status.HTTP_200_OK)
 
@@ -98,31 +308,97 @@ class OrderCollection(Resource):
     # LIST ALL ORDERS
     # ------------------------------------------------------------------
     @api.doc('list_orders')
-    @api.marshal_list_with(order_model)
+    @api.expect(search_args)
+    @api.response(400, 'The filters, sort or page parameters were not valid')
+    @api.response(200, 'Success', [order_model])
     def get(self):
-        """ Returns all of the Orders """
-        app.logger.info('Request to list Pets...')
-
-        orders = Order.all()
-
+        """
+        Returns all of the Orders matching the filters
+        The filters combine, the Item filters match Orders having one Item
+        matching all of them. Without a limit the whole result is streamed in
+        sort order. With a limit a single page is returned and X-Next-Page-Token
+        holds the token for the next one.
+        Send Accept: application/x-ndjson to receive one Order per line.
+        """
+        app.logger.info('Request to list Orders...')
+        args = search_args.parse_args()
+        limit = args["limit"]
+        sort = args["sort"]
+        filters = parse_search_filters(args)
+        after = check_search_token(args["after"], sort)
+        ndjson = wants_ndjson()
+
+        if limit is None:
+            app.logger.info('Streaming all Orders matching %s after %s', filters, after)
+            batches = Order.iter_search_batches(filters, sort, after, app.config["STREAM_BATCH_SIZE"])
+            return stream_orders(batches, ndjson)
+
+        check_page_limit(limit)
+        orders = Order.search(filters, sort, after, limit)
         app.logger.info('[%s] Orders returned', len(orders))
-        results = [order.serialize() for order in orders]
-        return results, status.HTTP_200_OK
+        headers = {}
+        if len(orders) == limit:
+            headers["X-Next-Page-Token"] = search_token(orders[-1], sort)
+        if ndjson:
+            return stream_orders([orders], ndjson, headers)
+        return marshal_orders(orders), status.HTTP_200_OK, headers
+
+    # ------------------------------------------------------------------
+    # DELETE MANY ORDERS
+    # ------------------------------------------------------------------
+    @api.doc('delete_orders')
+    @api.expect(delete_args)
+    @api.response(400, 'No or conflicting Orders were selected')
+    @api.marshal_with(delete_result_model)
+    def delete(self):
+        """
+        Deletes many Orders with their Items
+        Select the Orders either by id, repeating the id parameter, or by the
+        days they were created from start to end. Of a range of days at most
+        PURGE_BATCH_SIZE Orders are deleted per request, in one transaction;
+        more tells whether the request must be sent again.
+        """
+        args = delete_args.parse_args()
+        order_ids = args["id"] or []
+        start, end = parse_date_arg(args["start"]), parse_date_arg(args["end"])
+        app.logger.info("Request to delete Orders %s created from %s to %s", order_ids, start, end)
+        if bool(order_ids) == (start is not None or end is not None):
+            abort(status.HTTP_400_BAD_REQUEST, "Select the Orders to delete either by id or by start and end")
+        if order_ids:
+            if len(order_ids) > app.config["BULK_MAX_CHUNK_SIZE"]:
+                abort(status.HTTP_400_BAD_REQUEST, f"Invalid ids: at most {app.config['BULK_MAX_CHUNK_SIZE']}")
+            deleted, more = len(Order.delete_many(order_ids)), False
+        else:
+            if start is not None and end is not None and start > end:
+                abort(status.HTTP_400_BAD_REQUEST, "Invalid dates: start is after end")
+            # one batch per request, longer purges are left to flask purge-orders
+            deleted = Order.purge(start, end, app.config["PURGE_BATCH_SIZE"], max_batches=1)
+            more = Order.filtered(start=start, end=end).with_entities(Order.id).first() is not None
+        app.logger.info("[%s] Orders deleted, more left: %s", deleted, more)
+        return {"deleted": deleted, "more": more}, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # ADD A NEW ORDER
     # ------------------------------------------------------------------
-    @api.doc('create_orders')
+    @api.doc('create_orders', params={'Idempotency-Key': {
+        'in': 'header', 'type': 'string', 'description': 'Retries with the same key create the Order once'}})
     @api.response(400, 'The posted data was not valid')
+    @api.response(422, 'The Idempotency-Key was sent with another body')
     @api.expect(create_model)
     @api.marshal_with(order_model, code=201)
     def post(self):
         """
         Creates a Order
         This endpoint will create an Order based the data in the body that is posted
+        With an Idempotency-Key header the response is stored with the key, and
+        a retry with the same key and body returns it without creating another Order.
         """
         app.logger.info('Request to Create a Order')
         check_content_type("application/json")
+        check_item_quantities(api.payload)
+        key = request.headers.get("Idempotency-Key")
+        if key is not None:
+            return create_order_once(key)
         order = Order()
         app.logger.debug('Payload = %s', api.payload)
         data = api.payload
@@ -135,6 +411,65 @@ class OrderCollection(Resource):
         return order.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
 
+######################################################################
+#  PATH: /orders_bulk
+######################################################################
+@api.route('/orders_bulk', strict_slashes=False)
+class OrderBulk(Resource):
+    """ Handles the ingestion of many Orders at once """
+    # ------------------------------------------------------------------
+    # ADD MANY NEW ORDERS
+    # ------------------------------------------------------------------
+    @api.doc('bulk_create_orders')
+    @api.expect(bulk_args, [create_model])
+    @api.response(400, 'The request was not a list of Orders')
+    @api.response(415, 'The Content-Type was not JSON or NDJSON')
+    @api.marshal_list_with(bulk_result_model)
+    def post(self):
+        """
+        Creates many Orders with their Items
+        The body is either a JSON array of Orders, or one Order per line with
+        Content-Type application/x-ndjson. Every Order is validated on its own and
+        the valid ones are written chunk_size Orders per transaction. One result is
+        returned per Order, in the order they were sent.
+        """
+        app.logger.info('Request to bulk create Orders')
+        check_content_type("application/json", NDJSON_MIMETYPE)
+        chunk_size = bulk_args.parse_args()["chunk_size"]
+        if chunk_size is None:
+            chunk_size = app.config["BULK_CHUNK_SIZE"]
+        if not 0 < chunk_size <= app.config["BULK_MAX_CHUNK_SIZE"]:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Invalid chunk_size: must be between 1 and {app.config['BULK_MAX_CHUNK_SIZE']}",
+            )
+
+        if request.headers["Content-Type"] == NDJSON_MIMETYPE:
+            records = read_ndjson(request.stream)
+        else:
+            records = request.get_json()
+            if not isinstance(records, list):
+                abort(status.HTTP_400_BAD_REQUEST, "The body must be a JSON array of Orders")
+
+        results = []
+        chunk = []
+        for index, record in enumerate(records):
+            try:
+                chunk.append((index, deserialize_bulk_order(record)))
+            except DataValidationError as error:
+                results.append({"index": index, "status": status.HTTP_400_BAD_REQUEST, "error": str(error)})
+            if len(chunk) == chunk_size:
+                results.extend(create_chunk(chunk))
+                chunk = []
+        if chunk:
+            results.extend(create_chunk(chunk))
+
+        results.sort(key=lambda result: result["index"])
+        created = sum(1 for result in results if result["status"] == status.HTTP_201_CREATED)
+        app.logger.info('[%s] of [%s] Orders created in bulk', created, len(results))
+        return results, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /orders/{id}
 ######################################################################
@@ -152,18 +487,24 @@ class OrderResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_order')
     @api.response(404, 'Order not found')
-    @api.marshal_with(order_model)
+    @api.response(304, 'The Order did not change since the version in If-None-Match')
+    @api.response(200, 'Success', order_model)
     def get(self, order_id):
         """
         Retrieve a single Order
-        This endpoint will return an Order based on it's id
+        This endpoint will return an Order based on it's id. The ETag header
+        holds its version, send it back in If-None-Match to get 304 Not
+        Modified while the Order and its Items are unchanged.
         """
         app.logger.info("Request to Retrieve a order with id [%s]", order_id)
         check_valid_id(order_id)
-        order = Order.find(order_id)
+        not_modified = check_not_modified(order_id)
+        if not_modified:
+            return not_modified
+        order = Order.find_serialized(order_id)
         if not order:
             abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(order_id))
-        return order.serialize(), status.HTTP_200_OK
+        return marshal_order(order), status.HTTP_200_OK, etag_header(order)
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ORDER
@@ -171,6 +512,7 @@ class OrderResource(Resource):
     @api.doc('update_orders')
     @api.response(404, 'Order not found')
     @api.response(400, 'The posted Order data was not valid')
+    @api.response(412, 'The Order changed since the version in If-Match')
     @api.expect(order_model)
     @api.marshal_with(order_model)
     def put(self, order_id):
@@ -180,6 +522,7 @@ class OrderResource(Resource):
         """
         app.logger.info('Request to Update an order with id [%s]', order_id)
         check_valid_id(order_id)
+        check_if_match(order_id)
 
         order = Order.find(order_id)
         if not order:
@@ -191,7 +534,8 @@ class OrderResource(Resource):
         order.deserialize(data)
         order.id = order_id
         order.update()
-        return order.serialize(), status.HTTP_200_OK
+        order = order.serialize()
+        return order, status.HTTP_200_OK, etag_header(order)
 
     # ------------------------------------------------------------------
     # DELETE AN ORDER
@@ -199,6 +543,7 @@ class OrderResource(Resource):
     @api.doc('delete_orders')
     @api.response(204, 'Order deleted')
     @api.response(404, 'Order not found')
+    @api.response(412, 'The Order changed since the version in If-Match')
     def delete(self, order_id):
         """
         Delete an order
@@ -206,19 +551,48 @@ class OrderResource(Resource):
         """
         app.logger.info('Request to Delete an order with id [%s]', order_id)
         check_valid_id(order_id)
-        order = Order.find(order_id)
-        if order:
-            items_retrieve = Item.find_by_order_id(order_id)
-            if items_retrieve:
-                items_retrieve.delete()
-            order.delete()
-            app.logger.info('Order with id [%s] was deleted', order_id)
-        else:
+        check_if_match(order_id)
+        if not Order.delete_many([order_id]):
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
-
+        app.logger.info('Order with id [%s] was deleted', order_id)
         return '', status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+#  PATH: /orders/{id}/cancel, /orders/{id}/ship, /orders/{id}/deliver
+######################################################################
+@api.route('/orders/<order_id>/<any(cancel, ship, deliver):action>')
+@api.param('order_id', 'The Order identifier')
+@api.param('action', 'cancel, ship or deliver')
+class OrderAction(Resource):
+    """Moves an Order through its statuses: open, shipped, delivered or cancelled"""
+
+    @api.doc('order_action')
+    @api.response(404, 'Order not found')
+    @api.response(409, 'The Order can not take this action in its status')
+    @api.response(412, 'The Order changed since the version in If-Match')
+    @api.response(200, 'Success', order_model)
+    def put(self, order_id, action):
+        """
+        Cancel, ship or deliver an Order
+        An open Order can be cancelled or shipped, a shipped Order delivered.
+        Taking the action an Order already took again changes nothing.
+        """
+        app.logger.info("Request to %s the Order with id [%s]", action, order_id)
+        check_valid_id(order_id)
+        check_if_match(order_id)
+        new_status = ORDER_ACTIONS[action]
+        current = Order.change_status(int(order_id), new_status)
+        if current is None:
+            abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
+        if current != new_status:
+            abort(status.HTTP_409_CONFLICT, f"Order with id '{order_id}' is {current}, it can not be {new_status}.")
+        order = Order.find_serialized(int(order_id))
+        if not order:
+            abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
+        return marshal_order(order), status.HTTP_200_OK, etag_header(order)
+
+
 ######################################################################
 #  PATH: /orders/<order_id>/items/
 ######################################################################
@@ -230,17 +604,60 @@ class ItemCollection(Resource):
     # LIST ALL ITEM
     # ------------------------------------------------------------------
     @api.doc('list_items')
-    @api.marshal_list_with(item_model)
+    @api.response(404, 'Order not found')
+    @api.response(304, 'The Order did not change since the version in If-None-Match')
+    @api.response(200, 'Success', [item_model])
     def get(self, order_id):
-        """ Returns all items under an order"""
+        """ Returns all items under an order, with the ETag of the order"""
         app.logger.info("Request for all Items for Order with id: %s", order_id)
         check_valid_id(order_id)
-        order = Order.find(order_id)
+        not_modified = check_not_modified(order_id)
+        if not_modified:
+            return not_modified
+        order = Order.find_serialized(order_id)
         if not order:
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
 
-        results = [item.serialize() for item in order.items]
-        return results, status.HTTP_200_OK
+        return marshal_items(order["items"]), status.HTTP_200_OK, etag_header(order)
+
+    # ------------------------------------------------------------------
+    # CHANGE OR DELETE MANY ITEMS
+    # ------------------------------------------------------------------
+    @api.doc('change_items')
+    @api.expect([item_change_model])
+    @api.response(400, 'The request was not a list of changes')
+    @api.response(404, 'Order not found')
+    @api.response(412, 'The Order changed since the version in If-Match')
+    @api.marshal_list_with(item_change_result_model)
+    def patch(self, order_id):
+        """
+        Changes or deletes many Items of an Order at once
+        The body is a JSON array of changes, each one the id of an Item with its
+        new status, quantity or price, or with delete set to true. The valid
+        changes are made in a single transaction and one result is returned per
+        change, in the order they were sent, with the new ETag of the Order.
+        """
+        app.logger.info("Request to change the Items of Order %s", order_id)
+        check_content_type("application/json")
+        check_valid_id(order_id)
+        changes = request.get_json()
+        if not isinstance(changes, list):
+            abort(status.HTTP_400_BAD_REQUEST, "The body must be a JSON array of Item changes")
+        max_changes = app.config["BULK_MAX_CHUNK_SIZE"]
+        if len(changes) > max_changes:
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid changes: at most {max_changes} per request")
+        check_if_match(order_id)
+
+        results, updates, deletes = parse_item_changes(changes)
+        applied = Order.change_items(int(order_id), updates, deletes)
+        if applied is None:
+            abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
+        found, version = applied
+        for result in results:
+            if "id" in result and result["id"] not in found:
+                result.update(status=status.HTTP_404_NOT_FOUND, error=f"Item with id '{result['id']}' was not found.")
+        app.logger.info("[%s] Items changed and [%s] deleted", len(set(updates) & found), len(deletes & found))
+        return results, status.HTTP_200_OK, etag_header({"id": int(order_id), "version": version})
 
     # ------------------------------------------------------------------
     # ADD A NEW ITEM
@@ -276,7 +693,9 @@ class ItemCollection(Resource):
         location_url = api.url_for(ItemResource, item_id=item.id, order_id=order.id, _external=True)
         app.logger.info("Item for order ID [%s] created.", id)
 
-        return item.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
+        headers = order_etag_header(order.id)
+        headers['Location'] = location_url
+        return item.serialize(), status.HTTP_201_CREATED, headers
 
 
 ######################################################################
@@ -296,7 +715,8 @@ class ItemResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_item')
     @api.response(404, 'Item not found')
-    @api.marshal_with(item_model)
+    @api.response(304, 'The Order did not change since the version in If-None-Match')
+    @api.response(200, 'Success', item_model)
     def get(self, order_id, item_id):
         """
         Retrieve a single Order
@@ -305,17 +725,19 @@ class ItemResource(Resource):
         app.logger.info("Request for item with id [%s]", item_id)
         check_valid_id(order_id)
         check_valid_id(item_id)
+        not_modified = check_not_modified(order_id)
+        if not_modified:
+            return not_modified
 
-        order = Order.find(order_id)
+        order = Order.find_serialized(order_id)
         if not order:
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
-        app.logger.info(item_id)
-        item = Item.find(item_id)
+        item = next((item for item in order["items"] if item["id"] == int(item_id)), None)
         if not item:
             abort(status.HTTP_404_NOT_FOUND, f"Item with id '{item_id}' was not found.")
 
         app.logger.info("Get item details successful")
-        return item.serialize(), status.HTTP_200_OK
+        return marshal_item(item), status.HTTP_200_OK, etag_header(order)
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ITEM
@@ -323,6 +745,7 @@ class ItemResource(Resource):
     @api.doc('update_item')
     @api.response(404, 'Item not found')
     @api.response(400, 'The posted Item data was not valid')
+    @api.response(412, 'The Order changed since the version in If-Match')
     @api.expect(item_model)
     @api.marshal_with(item_model)
     def put(self, order_id, item_id):
@@ -336,28 +759,17 @@ class ItemResource(Resource):
         check_content_type("application/json")
         check_valid_id(order_id)
         check_valid_id(item_id)
-
-        order = Order.find(order_id)
-        if not order:
-            abort(status.HTTP_404_NOT_FOUND, f"Item with id '{order_id}' was not found.")
-
-        # See if the item exists and abort if it doesn't
-        item = Item.find(item_id)
-        if not item:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Order with id '{item_id}' could not be found.",
-            )
+        check_if_match(order_id)
+        item = find_item_or_404(order_id, item_id)
 
         # Update from the json in the body of the request
         check_valid_price(api.payload["price"])
         check_valid_id(api.payload["product_id"])
         check_valid_quantity(api.payload["quantity"])
         item.deserialize(api.payload)
-        item.id = item_id
         item.update()
 
-        return item.serialize(), status.HTTP_200_OK
+        return item.serialize(), status.HTTP_200_OK, order_etag_header(order_id)
 
     # ------------------------------------------------------------------
     # DELETE AN ITEM
@@ -365,6 +777,7 @@ class ItemResource(Resource):
     @api.doc('delete_items')
     @api.response(204, 'Item deleted')
     @api.response(404, 'Order not found')
+    @api.response(412, 'The Order changed since the version in If-Match')
     def delete(self, order_id, item_id):
         """
         Delete an item
@@ -375,14 +788,14 @@ class ItemResource(Resource):
             "Request to delete item with order_id [%s] and item_id [%s]", order_id, item_id)
         check_valid_id(order_id)
         check_valid_id(item_id)
+        check_if_match(order_id)
 
-        order = Order.find(order_id)
-        if not order:
+        order_found, item = Item.find_in_order(int(order_id), int(item_id))
+        if not order_found:
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
-        item = Item.find(item_id)
         if item:
             item.delete()
-        return "", status.HTTP_204_NO_CONTENT
+        return "", status.HTTP_204_NO_CONTENT, order_etag_header(order_id)
 
 
 ######################################################################
@@ -396,7 +809,7 @@ class DateQuery(Resource):
     # ORDER QUERY BASED ON DATE
     # ------------------------------------------------------------------
     @api.doc('order_retrieve_based_on_date')
-    @api.marshal_list_with(order_model)
+    @api.response(200, 'Success', [order_model])
     def get(self, date_iso):
         """ Returns all of the Orders under a single date in ISO format"""
         app.logger.info(
@@ -404,15 +817,49 @@ class DateQuery(Resource):
         )
         # check_content_type("application/json")
 
-        order_list = list(Order.find_by_date(date_iso))
+        order_list = Order.find_by_date_serialized(date_iso)
 
         if not order_list:
             abort(status.HTTP_404_NOT_FOUND, f"No order was found for date '{date_iso}'")
 
-        ret = []
-        for order in order_list:
-            ret.append(order.serialize())
-        return ret, status.HTTP_200_OK
+        return marshal_orders(order_list), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders_search
+######################################################################
+@api.route('/orders_search', strict_slashes=False)
+class TextSearch(Resource):
+    """ Handles text searches over the names and addresses of the Orders"""
+    # ------------------------------------------------------------------
+    # SEARCH ORDERS BY NAME AND ADDRESS
+    # ------------------------------------------------------------------
+    @api.doc('search_orders')
+    @api.expect(text_search_args)
+    @api.response(400, 'The search text or page parameters were not valid')
+    @api.response(200, 'Success', [search_result_model])
+    def get(self):
+        """
+        Returns the Orders whose name or address match the words of q
+        Every word must start a word of the name or of the address. The best
+        matches come first, one page of SEARCH_PAGE_SIZE Orders unless a limit
+        is given, X-Next-Page-Token holds the token for the next page.
+        """
+        args = text_search_args.parse_args()
+        words = Order.search_words(args["q"])
+        app.logger.info("Request to search Orders for %s", words)
+        if not words:
+            abort(status.HTTP_400_BAD_REQUEST, "Invalid search: q has no words")
+        limit = args["limit"] if args["limit"] is not None else app.config["SEARCH_PAGE_SIZE"]
+        check_page_limit(limit)
+        after = check_text_search_token(args["after"])
+
+        orders = Order.text_search(words, after, limit)
+        app.logger.info('[%s] Orders found', len(orders))
+        headers = {}
+        if len(orders) == limit:
+            headers["X-Next-Page-Token"] = encode_token({"rank": orders[-1]["rank"], "id": orders[-1]["id"]})
+        return marshal_search_results(orders), status.HTTP_200_OK, headers
 
 
 ######################################################################
@@ -425,38 +872,272 @@ class PriceQuery(Resource):
     # LIST ALL ITEMS IN ORDER IN PRICE RANGE
     # ------------------------------------------------------------------
     @api.doc('list_all_items_prices')
-    @api.marshal_list_with(order_model)
+    @api.response(400, 'The price range or page parameters were not valid')
+    @api.response(404, 'No Item found in the price range')
+    @api.response(200, 'Success', [order_model])
     @api.expect(price_model)
     def post(self):
-        """ Returns all of the Orders within the price range"""
+        """
+        Returns all of the Orders within the price range
+        Each Order only contains its Items within the price range.
+        """
         app.logger.info("Request for all Orders in the price range")
+        max_price, min_price, after_id, limit = parse_price_query()
 
-        data = request.get_json()
-        max_price = data['max_price']
-        min_price = data['min_price']
+        orders = Order.find_by_price(max_price, min_price, after_id, limit)
+        if not orders and after_id is None:
+            abort(status.HTTP_404_NOT_FOUND, "Items not found")
 
-        check_valid_price(max_price)
-        check_valid_price(min_price)
+        headers = {}
+        if limit is not None and len(orders) == limit:
+            headers["X-Next-Page-Token"] = encode_token({"id": orders[-1].id})
+        order_final = [order.serialize() for order in orders]
+        return marshal_orders(order_final), status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /orders_prices/items
+######################################################################
+@api.route('/orders_prices/items', strict_slashes=False)
+class PriceItemQuery(Resource):
+    """ Handles queries of the Items within a price range"""
+    # ------------------------------------------------------------------
+    # LIST ALL ITEMS IN PRICE RANGE
+    # ------------------------------------------------------------------
+    @api.doc('list_items_prices')
+    @api.response(400, 'The price range or page parameters were not valid')
+    @api.response(404, 'No Item found in the price range')
+    @api.response(200, 'Success', [item_model])
+    @api.expect(price_model)
+    def post(self):
+        """ Returns just the Items within the price range"""
+        app.logger.info("Request for all Items in the price range")
+        max_price, min_price, after_id, limit = parse_price_query()
 
-        item_list = Item.find_by_price(max_price, min_price)
-        if not item_list:
+        items = Item.find_by_price(max_price, min_price, after_id, limit).all()
+        if not items and after_id is None:
             abort(status.HTTP_404_NOT_FOUND, "Items not found")
 
-        results = [item.serialize() for item in item_list]
-        list_order_id = {}
-        for order_id in results:
-            list_order_id.setdefault(order_id["order_id"], []).append(order_id)
-        order_final = []
-        for key, value in list_order_id.items():
-            res = {}
-            order = Order.find(key)
-            res["id"] = order.id
-            res["name"] = order.name
-            res["address"] = order.address
-            res["date_created"] = order.date_created.isoformat()
-            res["items"] = value
-            order_final.append(order.serialize())
-        return order_final, status.HTTP_200_OK
+        headers = {}
+        if limit is not None and len(items) == limit:
+            headers["X-Next-Page-Token"] = encode_token({"id": items[-1].id})
+        results = [item.serialize() for item in items]
+        return marshal_items(results), status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /orders/{id}/total
+######################################################################
+@api.route('/orders/<order_id>/total')
+@api.param('order_id', 'The Order identifier')
+class OrderTotal(Resource):
+    """ Handles the total of a single Order """
+    # ------------------------------------------------------------------
+    # RETRIEVE THE TOTAL OF AN ORDER
+    # ------------------------------------------------------------------
+    @api.doc('get_order_total')
+    @api.response(404, 'Order not found')
+    @api.marshal_with(total_model)
+    def get(self, order_id):
+        """
+        Retrieve the total of an Order
+        The item count, quantity and total are computed by the database.
+        """
+        app.logger.info("Request for the total of Order with id: %s", order_id)
+        check_valid_id(order_id)
+        rows = Order.totals(order_id=int(order_id))
+        if not rows:
+            abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
+        return rows[0]._asdict(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders_totals
+######################################################################
+@api.route('/orders_totals', strict_slashes=False)
+class OrderTotals(Resource):
+    """ Handles the totals of all Orders """
+    # ------------------------------------------------------------------
+    # LIST THE TOTALS OF ALL ORDERS
+    # ------------------------------------------------------------------
+    @api.doc('list_order_totals')
+    @api.expect(report_args)
+    @api.response(400, 'The page parameters were not valid')
+    @api.marshal_list_with(total_model)
+    def get(self):
+        """
+        Returns the totals of the Orders in id order
+        One page at a time, X-Next-Page-Token holds the token for the next one.
+        """
+        app.logger.info("Request for the totals of all Orders")
+        args = report_args.parse_args()
+        limit = check_report_limit(args["limit"])
+        after_id = check_page_token(args["after"])
+
+        rows = Order.totals(after_id, limit)
+        headers = {}
+        if len(rows) == limit:
+            headers["X-Next-Page-Token"] = encode_token({"id": rows[-1].order_id})
+        return [row._asdict() for row in rows], status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /orders_revenue
+######################################################################
+@api.route('/orders_revenue', strict_slashes=False)
+class RevenueReport(Resource):
+    """ Handles the revenue by day """
+    # ------------------------------------------------------------------
+    # LIST THE REVENUE OF EVERY DAY
+    # ------------------------------------------------------------------
+    @api.doc('list_revenue_by_day')
+    @api.expect(revenue_args)
+    @api.response(400, 'The dates or page parameters were not valid')
+    @api.marshal_list_with(revenue_model)
+    def get(self):
+        """
+        Returns the Orders, Items and revenue of every day
+        Read from the daily rollups, which are kept up to date on every write.
+        Days without Orders are left out. One page at a time in date order,
+        X-Next-Page-Token holds the token for the next one.
+        """
+        app.logger.info("Request for the revenue by day")
+        args = revenue_args.parse_args()
+        limit = check_report_limit(args["limit"])
+        start = parse_date_arg(args["start"])
+        end = parse_date_arg(args["end"])
+        after = None
+        if args["after"] is not None:
+            try:
+                after = date.fromisoformat(decode_token(args["after"])["date"])
+            except (InvalidTokenError, KeyError, TypeError, ValueError) as e:
+                abort(status.HTTP_400_BAD_REQUEST, "Invalid page token: {}".format(e))
+
+        rows = DailyRollup.find_range(start, end, after, limit)
+        headers = {}
+        if len(rows) == limit:
+            headers["X-Next-Page-Token"] = encode_token({"date": rows[-1].date.isoformat()})
+        return [row._asdict() for row in rows], status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /orders_products
+######################################################################
+@api.route('/orders_products', strict_slashes=False)
+class ProductReport(Resource):
+    """ Handles the totals by product """
+    # ------------------------------------------------------------------
+    # LIST THE TOP PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('list_top_products')
+    @api.expect(report_args)
+    @api.response(400, 'The page parameters were not valid')
+    @api.marshal_list_with(product_model)
+    def get(self):
+        """
+        Returns the products with the highest revenue first
+        Read from the product summary, which is kept up to date on every
+        write of an Item. X-Next-Page-Token holds the token for the next page.
+        """
+        app.logger.info("Request for the top products")
+        args = report_args.parse_args()
+        limit = check_report_limit(args["limit"])
+        after = None
+        if args["after"] is not None:
+            try:
+                cursor = decode_token(args["after"])
+                after = (float(cursor["revenue"]), int(cursor["product_id"]))
+            except (InvalidTokenError, KeyError, TypeError, ValueError) as e:
+                abort(status.HTTP_400_BAD_REQUEST, "Invalid page token: {}".format(e))
+
+        products = ProductSummary.top(after, limit)
+        headers = {}
+        if len(products) == limit:
+            last = products[-1]
+            headers["X-Next-Page-Token"] = encode_token(
+                {"revenue": last.revenue, "product_id": last.product_id}
+            )
+        return [product.serialize() for product in products], status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /orders_sync
+######################################################################
+@api.route('/orders_sync', strict_slashes=False)
+class OrderSync(Resource):
+    """ Handles the incremental sync of the Orders """
+    # ------------------------------------------------------------------
+    # SYNC THE CHANGES SINCE A TOKEN
+    # ------------------------------------------------------------------
+    @api.doc('sync_orders')
+    @api.expect(sync_args)
+    @api.response(400, 'The token or limit were not valid')
+    @api.response(410, 'The token is too old, download all the Orders again')
+    @api.response(200, 'Success', sync_model)
+    def get(self):
+        """
+        Returns the Orders changed and deleted since the last sync
+        Send the token of the last sync to get what changed since, the first
+        sync without a token only returns a token to start from.
+        """
+        args = sync_args.parse_args()
+        limit = args["limit"]
+        if limit is None:
+            limit = app.config["SYNC_PAGE_SIZE"]
+        check_page_limit(limit)
+        if args["token"] is None:
+            app.logger.info("Request for a new sync token")
+            result = {"orders": [], "deleted": [], "token": encode_token({"event": OrderEvent.last_id()}), "more": False}
+            return marshal_sync(result), status.HTTP_200_OK
+        after = check_sync_token(args["token"])
+        app.logger.info("Request for the orders changed after event %s", after)
+        if OrderEvent.pruned_after(after):
+            abort(status.HTTP_410_GONE, "The sync token is too old, download all the Orders again")
+        orders, deleted, last, more = Order.changes(after, limit)
+        result = {"orders": orders, "deleted": deleted, "token": encode_token({"event": last}), "more": more}
+        return marshal_sync(result), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders_events
+######################################################################
+@api.route('/orders_events', strict_slashes=False)
+class OrderEvents(Resource):
+    """ Handles the change events of the Orders and Items """
+    # ------------------------------------------------------------------
+    # LIST OR STREAM THE CHANGES
+    # ------------------------------------------------------------------
+    @api.doc('list_order_events')
+    @api.expect(event_args)
+    @api.response(400, 'The cursor, limit or wait were not valid')
+    @api.response(200, 'Success', [event_model])
+    def get(self):
+        """
+        Returns the changes to the Orders and Items after an event, oldest first
+        With wait the request is held until there is an event or the seconds
+        went by (long polling). Send Accept: text/event-stream to receive the
+        events as server-sent events instead, resuming from Last-Event-ID.
+        """
+        args = event_args.parse_args()
+        after = args["after"]
+        if after is None and request.headers.get("Last-Event-ID"):
+            after = check_event_id(request.headers["Last-Event-ID"])
+        app.logger.info("Request for the order events after %s", after)
+        limit = args["limit"]
+        if limit is None:
+            limit = app.config["EVENT_PAGE_SIZE"]
+        check_page_limit(limit)
+        max_wait = app.config["EVENT_MAX_WAIT"]
+        if not 0 <= args["wait"] <= max_wait:
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid wait: must be between 0 and {max_wait} seconds")
+
+        best = request.accept_mimetypes.best_match(["application/json", EVENT_STREAM_MIMETYPE])
+        if best == EVENT_STREAM_MIMETYPE:
+            return Response(
+                stream_with_context(stream_events(after, limit)),
+                mimetype=EVENT_STREAM_MIMETYPE, headers={"Cache-Control": "no-cache"},
+            )
+        return marshal_events(wait_for_events(after, limit, args["wait"])), status.HTTP_200_OK
 
 
 ######################################################################
@@ -466,7 +1147,7 @@ def check_valid_id(s):
     """Check whether a string could be converted into a num. for ID"""
     try:
         int(s)
-    except ValueError as e:
+    except (TypeError, ValueError) as e:
         abort(status.HTTP_400_BAD_REQUEST, "Invalid ID: {}".format(e))
 
 
@@ -474,26 +1155,464 @@ def check_valid_price(s):
     """Check whether a string could be converted to float"""
     try:
         float(s)
-    except ValueError as e:
+    except (TypeError, ValueError) as e:
         abort(status.HTTP_400_BAD_REQUEST, "Invalid price: {}".format(e))
 
 
+def whole_number(value):
+    """Converts a quantity, which must be a whole number: 3.7 or true are refused"""
+    if isinstance(value, bool) or int(value) != float(value):
+        raise ValueError(f"{value!r} is not a whole number")
+    return int(value)
+
+
 def check_valid_quantity(s):
-    """Check whether a string could be converted to float"""
+    """Check whether a value could be converted to a whole number"""
     try:
-        int(s)
-    except ValueError as e:
+        whole_number(s)
+    except (TypeError, ValueError) as e:
         abort(status.HTTP_400_BAD_REQUEST, "Invalid quantity: {}".format(e))
 
 
+def check_item_quantities(data):
+    """Checks the quantities of the Items of an Order body are whole numbers"""
+    items = data.get("items") if isinstance(data, dict) else None
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and "quantity" in item:
+            check_valid_quantity(item["quantity"])
+
+
 def check_valid_date(s):
     """Check whether a string could be converted to date"""
     try:
         date.fromisoformat(s)
-    except ValueError as e:
+    except (TypeError, ValueError) as e:
         abort(status.HTTP_400_BAD_REQUEST, "Invalid date: {}".format(e))
 
 
+def parse_datetime_arg(value):
+    """Converts an ISO date and time query parameter, in UTC"""
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError as e:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid date and time: {}".format(e))
+
+
+def check_page_token(token):
+    """Decodes a keyset page token into the id of the last Order seen"""
+    if token is None:
+        return None
+    try:
+        return int(decode_token(token)["id"])
+    except (InvalidTokenError, KeyError, TypeError, ValueError) as e:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid page token: {}".format(e))
+
+
+def parse_search_filters(args):
+    """Reads the filters of an Order search from the parsed query string"""
+    filters = {
+        name: args[name] for name in ("name", "product_id", "min_price", "max_price", "status", "order_status")
+        if args[name] is not None
+    }
+    status_since = parse_date_arg(args["status_since"])
+    if status_since is not None:
+        filters["status_since"] = status_since
+    if args["updated_since"] is not None:
+        filters["updated_since"] = parse_datetime_arg(args["updated_since"])
+    start, end = parse_date_arg(args["start"]), parse_date_arg(args["end"])
+    if start is not None:
+        filters["start"] = start
+    if end is not None:
+        filters["end"] = end
+    if start is not None and end is not None and start > end:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid dates: start is after end")
+    if filters.get("min_price", 0) > filters.get("max_price", float("inf")):
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid prices: min_price is above max_price")
+    return filters
+
+
+def search_token(order, sort):
+    """Returns the page token to the Orders of a search after a serialized Order"""
+    cursor = {"id": order["id"]}
+    if sort != "id":
+        cursor.update(sort=sort, key=order[sort.lstrip("-")])
+    return encode_token(cursor)
+
+
+def check_search_token(token, sort):
+    """Decodes the page token of a search into the cursor of the last Order seen"""
+    if token is None:
+        return None
+    try:
+        cursor = decode_token(token)
+        if cursor.get("sort", "id") != sort:
+            raise ValueError(f"it does not belong to the sort {sort}")
+        order = {"id": int(cursor["id"])}
+        order.setdefault(sort.lstrip("-"), cursor.get("key"))
+        return Order.sort_cursor(order, sort)
+    except (InvalidTokenError, KeyError, TypeError, ValueError) as e:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid page token: {}".format(e))
+    return None
+
+
+def check_text_search_token(token):
+    """Decodes the page token of a text search into the (rank, id) of the last Order seen"""
+    if token is None:
+        return None
+    try:
+        cursor = decode_token(token)
+        return float(cursor["rank"]), int(cursor["id"])
+    except (InvalidTokenError, KeyError, TypeError, ValueError) as e:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid page token: {}".format(e))
+    return None
+
+
+def parse_price_query():
+    """Reads the price range and the page parameters of a price query"""
+    data = request.get_json()
+    max_price = data['max_price']
+    min_price = data['min_price']
+
+    check_valid_price(max_price)
+    check_valid_price(min_price)
+
+    limit = data.get('limit')
+    if limit is not None:
+        check_valid_quantity(limit)
+        limit = int(limit)
+        check_page_limit(limit)
+    after_id = check_page_token(data.get('after'))
+    return float(max_price), float(min_price), after_id, limit
+
+
+def read_ndjson(stream):
+    """Yields one decoded JSON document per non-blank line of a stream"""
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield e
+
+
+def deserialize_bulk_order(data):
+    """Validates one Order of a bulk request and builds it with its Items"""
+    if isinstance(data, ValueError):
+        raise DataValidationError("Invalid order: malformed JSON - {}".format(data))
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid order: body of request contained bad or no data")
+    try:
+        order = Order().deserialize(data)
+        for item in order.items:
+            item.product_id = int(item.product_id)
+            item.price = float(item.price)
+            item.quantity = whole_number(item.quantity)
+            item.status = item_status(item.status)
+    except (TypeError, ValueError) as e:
+        raise DataValidationError("Invalid order: {}".format(e)) from e
+    for field in ("name", "address"):
+        check_text_column(getattr(order, field), Order.__table__.c[field])
+    return order
+
+
+def check_text_column(value, column):
+    """Checks a value is a string that fits a text column"""
+    if not isinstance(value, str):
+        raise DataValidationError(f"Invalid order: {column.name} must be a string")
+    length = column.type.length
+    if length is not None and len(value) > length:
+        raise DataValidationError(f"Invalid order: {column.name} must be at most {length} characters")
+
+
+def item_status(value):
+    """Converts the status of an Item change, which must be a non empty string"""
+    if not isinstance(value, str) or not value:
+        raise ValueError("status must be a non empty string")
+    return value
+
+
+def item_quantity(value):
+    """Checks the quantity of an Item change, which must be a positive integer"""
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError("quantity must be a positive integer")
+    return value
+
+
+def item_price(value):
+    """Checks the price of an Item change, which must be a finite number, 0 or more"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+        raise ValueError("price must be a finite number, 0 or more")
+    return float(value)
+
+
+# The Item columns a batch of Item changes may set, with their conversions
+ITEM_CHANGE_TYPES = {"status": item_status, "quantity": item_quantity, "price": item_price}
+
+
+def parse_item_changes(changes):
+    """Validates a batch of Item changes
+
+    :return: one result per change, the new values by Item id and the ids
+             of the Items to delete
+    :rtype: tuple
+    """
+    results, updates, deletes = [], {}, set()
+    for index, change in enumerate(changes):
+        try:
+            item_id, values = parse_item_change(change)
+            if item_id in updates or item_id in deletes:
+                raise DataValidationError(f"Invalid change: Item {item_id} is changed twice")
+        except DataValidationError as error:
+            results.append({"index": index, "status": status.HTTP_400_BAD_REQUEST, "error": str(error)})
+            continue
+        if values is None:
+            deletes.add(item_id)
+            results.append({"index": index, "id": item_id, "status": status.HTTP_204_NO_CONTENT})
+        else:
+            updates[item_id] = values
+            results.append({"index": index, "id": item_id, "status": status.HTTP_200_OK})
+    return results, updates, deletes
+
+
+def parse_item_change(change):
+    """Validates one change of a batch of Item changes
+
+    :return: the id of the Item and its new values, or None to delete it
+    :rtype: tuple
+    """
+    if not isinstance(change, dict):
+        raise DataValidationError("Invalid change: it must be a JSON object")
+    unknown = set(change) - {"id", "delete"} - set(ITEM_CHANGE_TYPES)
+    if unknown:
+        raise DataValidationError(f"Invalid change: {', '.join(sorted(unknown))} can not be changed")
+    try:
+        item_id = int(change["id"])
+        if change.get("delete"):
+            return item_id, None
+        values = {
+            column: to_type(change[column]) for column, to_type in ITEM_CHANGE_TYPES.items() if column in change
+        }
+    except KeyError as e:
+        raise DataValidationError("Invalid change: missing id") from e
+    except (TypeError, ValueError) as e:
+        raise DataValidationError("Invalid change: {}".format(e)) from e
+    if not values:
+        raise DataValidationError(f"Invalid change: nothing to change on Item {item_id}")
+    return item_id, values
+
+
+def create_chunk(chunk):
+    """Stores a chunk of validated Orders and returns their results
+
+    When the database refuses the chunk its Orders are stored one at a time,
+    so only the Orders it refuses on their own fail.
+    """
+    try:
+        Order.bulk_create([order for _, order in chunk])
+    except SQLAlchemyError as e:
+        app.logger.error("Bulk chunk of %s Orders failed: %s", len(chunk), e)
+        if len(chunk) > 1:
+            return [result for entry in chunk for result in create_chunk([entry])]
+        return [{"index": chunk[0][0], "status": status.HTTP_409_CONFLICT, "error": "Order could not be stored"}]
+    return [
+        {
+            "index": index, "status": status.HTTP_201_CREATED,
+            "id": order.id, "item_ids": [item.id for item in order.items]
+        }
+        for index, order in chunk
+    ]
+
+
+def check_report_limit(limit):
+    """Returns the page size of a report, MAX_PAGE_SIZE when none is given"""
+    if limit is None:
+        return app.config["MAX_PAGE_SIZE"]
+    check_page_limit(limit)
+    return limit
+
+
+def parse_date_arg(value):
+    """Converts an optional ISO date query parameter"""
+    if value is None:
+        return None
+    check_valid_date(value)
+    return date.fromisoformat(value)
+
+
+def check_page_limit(limit):
+    """Check whether a page size is within the configured bounds"""
+    max_page_size = app.config["MAX_PAGE_SIZE"]
+    if not 0 < limit <= max_page_size:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Invalid limit: must be between 1 and {max_page_size}",
+        )
+
+
+def create_order_once(key):
+    """Creates the posted Order unless a request with the same Idempotency-Key did"""
+    if not 0 < len(key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid Idempotency-Key: 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+    request_hash = hashlib.sha256(request.get_data()).hexdigest()
+    stored = IdempotencyKey.find(key)
+    if stored is None:
+        data = api.payload
+        if "date_created" in data.keys():
+            check_valid_date(data["date_created"])
+        order = Order()
+        order.deserialize(data)
+        stored = IdempotencyKey.create_order(key, request_hash, order)
+    if stored.request_hash != request_hash:
+        abort(status.HTTP_422_UNPROCESSABLE_ENTITY, "The Idempotency-Key was already used with another body")
+    order_id = stored.response["id"]
+    app.logger.info('Order [%s] created for Idempotency-Key %s', order_id, key)
+    location_url = api.url_for(OrderResource, order_id=order_id, _external=True)
+    return stored.response, stored.status_code, {'Location': location_url}
+
+
+def find_item_or_404(order_id, item_id):
+    """Returns an Item of an Order, aborting with 404 if either is missing"""
+    order_found, item = Item.find_in_order(int(order_id), int(item_id))
+    if not order_found:
+        abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
+    if item is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Item with id '{item_id}' was not found in Order '{order_id}'.")
+    return item
+
+
+def check_sync_token(token):
+    """Decodes a sync token into the id of the last change event synced"""
+    try:
+        return int(decode_token(token)["event"])
+    except (InvalidTokenError, KeyError, TypeError, ValueError) as e:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid sync token: {}".format(e))
+
+
+def check_event_id(value):
+    """Converts the id of the last event a client received"""
+    try:
+        return int(value)
+    except ValueError as e:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid event id: {}".format(e))
+
+
+def wait_for_events(after, limit, wait):
+    """Reads the outbox until there are events after an id or wait seconds went by
+
+    The session is closed between reads, so no connection is held while waiting.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        events = OrderEvent.after(after, limit)
+        remaining = deadline - time.monotonic()
+        if events or remaining <= 0:
+            return events
+        db.session.remove()
+        time.sleep(min(app.config["EVENT_POLL_INTERVAL"], remaining))
+
+
+def stream_events(after, limit):
+    """Yields the events after an id as server-sent events for EVENT_STREAM_SECONDS
+
+    A comment is sent after every read that found nothing, so a client that
+    went away is noticed. The client reconnects with the Last-Event-ID it got.
+    """
+    interval = app.config["EVENT_POLL_INTERVAL"]
+    deadline = time.monotonic() + app.config["EVENT_STREAM_SECONDS"]
+    yield f"retry: {int(interval * 1000)}\n\n"
+    while True:
+        events = OrderEvent.after(after, limit)
+        db.session.remove()
+        for event in events:
+            yield f"id: {event['id']}\nevent: {event['entity']}.{event['action']}\ndata: {dumps(event)}\n\n"
+        if not events:
+            yield ": waiting\n\n"
+        else:
+            after = events[-1]["id"]
+        if time.monotonic() >= deadline:
+            return
+        if len(events) < limit:
+            time.sleep(interval)
+
+
+def etag_header(order):
+    """Returns the strong ETag of a serialized Order and its Items as a header"""
+    return {"ETag": quote_etag(f"{order['id']}-{order['version']}")}
+
+
+def order_etag_header(order_id):
+    """Returns the ETag of an Order after a write to its Items, read from the database"""
+    order_id = int(order_id)
+    return etag_header({"id": order_id, "version": Order.find_version(order_id)})
+
+
+def check_not_modified(order_id):
+    """Returns a 304 Not Modified response if If-None-Match has the current version
+
+    Only the version of the Order is read, from the database so a cache behind
+    another worker can never answer 304 for an Order that changed. The Order
+    itself is not loaded or serialized.
+    """
+    if not request.if_none_match:
+        return None
+    order_id = int(order_id)
+    version = Order.find_version(order_id)
+    if version is None or not request.if_none_match.contains_weak(f"{order_id}-{version}"):
+        return None
+    app.logger.info("Order [%s] not modified since version %s", order_id, version)
+    headers = etag_header({"id": order_id, "version": version})
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+def check_if_match(order_id):
+    """Aborts with 412 Precondition Failed if If-Match is not the current version
+
+    The Order is locked until the request commits, so no other request can
+    change it between the check and the write.
+    """
+    if not request.if_match:
+        return
+    order_id = int(order_id)
+    version = Order.find_version(order_id, lock=True)
+    if version is None:
+        return  # answered with 404 by the caller
+    # compressed responses carry the ETag as weak (see common/compression.py),
+    # it still names exactly one version so it is accepted here
+    if not request.if_match.contains_weak(f"{order_id}-{version}"):
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Order with id '{order_id}' is at version {version}, it changed since it was read.",
+        )
+
+
+def wants_ndjson():
+    """Checks whether the client asked for newline delimited JSON"""
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def stream_orders(batches, ndjson, headers=None):
+    """Streams batches of serialized Orders as a chunked JSON array or as NDJSON"""
+    def generate():
+        first = True
+        if not ndjson:
+            yield "["
+        for batch in batches:
+            for order in batch:
+                body = dumps(marshal_order(order))
+                if ndjson:
+                    yield body + "\n"
+                else:
+                    yield body if first else "," + body
+                first = False
+        if not ndjson:
+            yield "]"
+
+    mimetype = NDJSON_MIMETYPE if ndjson else "application/json"
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, headers, mimetype=mimetype)
+
+
 def init_db():
     """ Initializes the SQLAlchemy app """
     global app
@@ -501,21 +1620,22 @@ def init_db():
     Order.init_db(app)
 
 
-def check_content_type(content_type):
-    """Checks that the media type is correct"""
+def check_content_type(*content_types):
+    """Checks that the media type is one of the given ones"""
+    expected = " or ".join(content_types)
     if "Content-Type" not in request.headers:
         app.logger.error("No Content-Type specified.")
         abort(
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            f"Content-Type must be {content_type}",
+            f"Content-Type must be {expected}",
         )
 
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
         return
 
     app.logger.error("Invalid Content-Type: %s",
                      request.headers["Content-Type"])
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        f"Content-Type must be {content_type}",
+        f"Content-Type must be {expected}",
     )
@@ -0,0 +1,34 @@
+"""
+SQL statement counter for tests
+
+Used to assert how many round-trips to the database an operation makes so
+that N+1 query regressions are caught by the test suite:
+
+    with QueryCounter(db.engine) as queries:
+        self.client.get("/api/orders")
+    self.assertEqual(queries.count, 2)
+"""
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """Records every SQL statement sent through an engine while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        """The number of statements executed so far"""
+        return len(self.statements)
@@ -0,0 +1,109 @@
+"""
+Test cases for the Order Cache
+
+"""
+import unittest
+from service.common.cache import LRUCache, LocalStore, SharedCache, NullCache, OrderCache
+
+
+class FakeClock:
+    """A clock the tests move forward by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestOrderCache(unittest.TestCase):
+    """ Test Cases for the cache backends """
+
+    def setUp(self):
+        """This runs before each test"""
+        self.clock = FakeClock()
+
+    def test_lru_get_and_set(self):
+        """It should store and return values"""
+        cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"id": 1})
+        self.assertEqual(cache.get(1), {"id": 1})
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+
+    def test_lru_evicts_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), "one")
+
+    def test_lru_expires_entries(self):
+        """It should expire entries after their ttl"""
+        cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+        cache.set(1, "one")
+        self.clock.now = 9.9
+        self.assertEqual(cache.get(1), "one")
+        self.clock.now = 10.0
+        self.assertIsNone(cache.get(1))
+
+    def test_shared_cache_with_local_store(self):
+        """It should share JSON values through the store"""
+        store = LocalStore(clock=self.clock)
+        writer = SharedCache(store, ttl=10)
+        reader = SharedCache(store, ttl=10)
+        writer.set(1, {"id": 1, "items": []})
+        self.assertEqual(reader.get(1), {"id": 1, "items": []})
+        reader.delete(1)
+        self.assertIsNone(writer.get(1))
+
+        writer.set(2, {"id": 2})
+        self.clock.now = 10.0
+        self.assertIsNone(reader.get(2))
+
+        writer.set(3, {"id": 3})
+        writer.clear()
+        self.assertIsNone(reader.get(3))
+
+    def test_reserved_set_after_invalidation(self):
+        """It should not cache a value read before the entry was invalidated"""
+        store = LocalStore(clock=self.clock)
+        for backend in (LRUCache(clock=self.clock), SharedCache(store, ttl=10)):
+            cache = OrderCache(backend)
+            token = cache.reserve(1)
+            cache.invalidate(1)  # a write committed while the reader was reading
+            cache.set(1, {"id": 1, "version": 1}, token)
+            self.assertIsNone(cache.get(1))
+
+            token = cache.reserve(1)
+            cache.set(1, {"id": 1, "version": 2}, token)
+            self.assertEqual(cache.get(1), {"id": 1, "version": 2})
+            # a token is good for one set
+            cache.set(1, {"id": 1, "version": 1}, token)
+            self.assertEqual(cache.get(1), {"id": 1, "version": 2})
+
+    def test_order_cache_counts(self):
+        """It should count hits, misses and invalidations"""
+        cache = OrderCache(LRUCache(clock=self.clock))
+        self.assertIsNone(cache.get("1"))
+        cache.set(1, {"id": 1})
+        self.assertEqual(cache.get("1"), {"id": 1})
+        cache.invalidate(1)
+        cache.invalidate(None)
+        self.assertIsNone(cache.get(1))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["invalidations"]), (1, 2, 1))
+
+    def test_null_cache(self):
+        """It should never store anything when disabled"""
+        cache = OrderCache(NullCache())
+        cache.set(1, {"id": 1})
+        self.assertIsNone(cache.get(1))
@@ -0,0 +1,99 @@
+"""
+Test cases for the Response Compression
+
+"""
+import gzip
+import unittest
+from flask import Flask, Response, jsonify
+from werkzeug.datastructures import Accept
+from service.common.compression import (
+    COMPRESSORS, available_encodings, choose_encoding, init_compression
+)
+
+
+def make_app():
+    """Returns a Flask app with compression and a few views"""
+    app = Flask(__name__)
+    app.config.update(COMPRESS_ENCODINGS="zstd,br,gzip", COMPRESS_MIN_SIZE=100)
+    init_compression(app)
+
+    @app.route("/small")
+    def small():
+        return jsonify(value=1)
+
+    @app.route("/large")
+    def large():
+        response = jsonify(values=list(range(200)))
+        response.headers["ETag"] = '"1-1"'
+        return response
+
+    @app.route("/text")
+    def text():
+        return Response("x" * 1000, mimetype="text/plain")
+
+    @app.route("/stream")
+    def stream():
+        return Response((f'{{"n": {n}}}\n' for n in range(1000)), mimetype="application/x-ndjson")
+
+    return app
+
+
+######################################################################
+#  C O M P R E S S I O N   T E S T   C A S E S
+######################################################################
+class TestCompression(unittest.TestCase):
+    """ Test Cases for the response compression """
+
+    def setUp(self):
+        """This runs before each test"""
+        self.client = make_app().test_client()
+
+    def test_available_encodings(self):
+        """It should only offer the installed encodings"""
+        self.assertEqual(available_encodings("nonsense, gzip"), ["gzip"])
+        self.assertEqual(available_encodings(""), [])
+        self.assertEqual(available_encodings("zstd,br,gzip")[-1], "gzip")
+
+    def test_choose_encoding(self):
+        """It should choose the offered encoding the client prefers"""
+        offered = ["zstd", "br", "gzip"]
+        self.assertEqual(choose_encoding(Accept([("gzip", 1), ("br", 1)]), offered), "br")
+        self.assertEqual(choose_encoding(Accept([("gzip", 1), ("br", 0.5)]), offered), "gzip")
+        self.assertEqual(choose_encoding(Accept([("*", 1)]), offered), "zstd")
+        self.assertIsNone(choose_encoding(Accept([("deflate", 1)]), offered))
+        self.assertIsNone(choose_encoding(Accept([("gzip", 0)]), ["gzip"]))
+        self.assertIsNone(choose_encoding(Accept(), offered))
+
+    def test_compress_large_json(self):
+        """It should compress a JSON body above the threshold"""
+        plain = self.client.get("/large")
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertEqual(plain.headers["Vary"], "Accept-Encoding")
+        response = self.client.get("/large", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+        self.assertEqual(response.headers["ETag"], 'W/"1-1"')
+
+    def test_skip_small_and_other_bodies(self):
+        """It should send small and non JSON bodies as they are"""
+        for path in ["/small", "/text"]:
+            response = self.client.get(path, headers={"Accept-Encoding": "gzip"})
+            self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_compress_stream(self):
+        """It should compress a streamed body chunk by chunk"""
+        plain = self.client.get("/stream").data
+        response = self.client.get("/stream", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", response.headers)
+        self.assertEqual(gzip.decompress(response.data), plain)
+        self.assertLess(len(response.data), len(plain))
+
+    def test_compressors_round_trip(self):
+        """It should compress with every installed encoding"""
+        for name, factory in COMPRESSORS.items():
+            compressor = factory()
+            data = compressor.compress(b"[1, 2, 3]" * 100) + compressor.flush()
+            self.assertLess(len(data), 900, name)
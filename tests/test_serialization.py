@@ -0,0 +1,99 @@
+"""
+Test cases for the Response Serialization
+
+"""
+import json
+import unittest
+from datetime import date
+from decimal import Decimal
+from flask_restx import fields, marshal
+from service import app
+from service.routes import order_model, item_model, total_model, revenue_model
+from service.common.serialization import compile_model, compile_list, dumps, orjson
+
+
+def make_order(order_id, items=2):
+    """Returns a serialized Order with Items"""
+    return {
+        "id": order_id, "name": f"Order {order_id}", "address": "1 Main St",
+        "date_created": "2022-12-01",
+        "items": [
+            {"id": order_id * 10 + n, "product_id": n, "price": 1.5 * n, "quantity": n,
+             "order_id": order_id, "status": "ok"}
+            for n in range(items)
+        ],
+    }
+
+
+######################################################################
+#  S E R I A L I Z A T I O N   T E S T   C A S E S
+######################################################################
+class TestSerialization(unittest.TestCase):
+    """ Test Cases for the compiled models and the JSON backends """
+
+    def setUp(self):
+        """This runs before each test"""
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.context.pop()
+
+    def test_compiled_model_matches_marshal(self):
+        """It should marshal Orders like marshal() does"""
+        orders = [make_order(n, items=n % 3) for n in range(1, 6)]
+        self.assertEqual(compile_list(order_model)(orders), marshal(orders, order_model))
+        item = orders[1]["items"][0]
+        self.assertEqual(compile_model(item_model)(item), marshal(item, item_model))
+
+    def test_compiled_model_missing_values(self):
+        """It should use the defaults of the fields for missing values"""
+        data = {"name": None, "items": None, "date_created": None}
+        self.assertEqual(compile_model(order_model)(data), marshal(data, order_model))
+        self.assertEqual(compile_model(total_model)({}), marshal({}, total_model))
+
+    def test_compiled_model_converts_values(self):
+        """It should convert values to the types of the fields"""
+        data = {
+            "date": date(2022, 12, 1), "orders": "3", "items": 4.0,
+            "quantity": True, "revenue": "12.5", "distinct_products": 2,
+        }
+        compiled = compile_model(revenue_model)(data)
+        self.assertEqual(compiled, marshal(data, revenue_model))
+        self.assertEqual(compiled["date"], "2022-12-01")
+        self.assertEqual(compiled["revenue"], 12.5)
+
+    def test_compiled_model_other_fields(self):
+        """It should fall back to the fields it does not specialize"""
+        model = {
+            "flag": fields.Boolean,
+            "when": fields.DateTime(dt_format="iso8601"),
+            "renamed": fields.String(attribute="name"),
+            "tags": fields.List(fields.String),
+        }
+        data = {"flag": 1, "when": "2022-12-01T10:00:00", "name": "x", "tags": ["a", 1]}
+        self.assertEqual(compile_model(model)(data), marshal(data, model))
+
+    def test_compiled_model_invalid_value(self):
+        """It should raise the marshalling error of the field"""
+        with self.assertRaises(fields.MarshallingError):
+            compile_model(item_model)({"product_id": "abc"})
+
+    def test_dumps_backends(self):
+        """It should encode the same documents with both backends"""
+        data = [make_order(1), {"total": Decimal("2.5"), "day": date(2022, 12, 1)}]
+        expected = [make_order(1), {"total": 2.5, "day": "2022-12-01"}]
+        self.assertEqual(json.loads(dumps(data, backend="json")), expected)
+        self.assertEqual(json.loads(dumps(data, backend="orjson")), expected)
+        self.assertEqual(json.loads(dumps(data)), expected)
+        with self.assertRaises(TypeError):
+            dumps({"value": object()}, backend="json")
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def test_responses_use_backend(self):
+        """It should encode the responses of the api with the JSON_BACKEND"""
+        client = app.test_client()
+        response = client.get("/api/orders_totals?limit=0")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, orjson.dumps(response.get_json()) + b"\n")